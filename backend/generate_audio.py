@@ -1,56 +1,70 @@
+import asyncio
 import os
 from config import FISH_AUDIO_API_KEY
 from config import REFERENCE_ID
 from fishaudio.client import FishAudio
 from fishaudio.utils import save
 
+# Most Fish Audio requests a single transcribe_all call has in flight at once
+MAX_CONCURRENT_TTS = 3
+
+# Narration text per page, indexed by page_index + 1 (pages -1 through 10)
+_PAGE_TEXTS = (
+    # -1: intro
+    "Hey, it's your favorite AI company CEO. Welcome to GPT Rewind! Let's take a look at what you have here...",
+    # 0: total hours
+    "Here's the total amount of time you spent on GPT this year. Hopefully you used that time wisely. But if you didn't... don't worry. Your secret is safe with us.",
+    # 1: total hours by month
+    "And here's the amount of hours you spent grouped by month. Looks like [month] was your biggest month!",
+    # 2: total hours grouped by hour/frequency of hours
+    "Let's take a look at what times of the day you used GPT the most.",
+    # 3: longest conversation duration
+    "Here's the longest time you spent conversing with GPT. [hour] hours! I wonder what you were doing then.",
+    # 4: easiest question
+    "Here's the easiest question you asked this year. Don't worry, we all have that moment sometimes.",
+    # 5: hardest question
+    "And here's the hardest question you asked.",
+    # 6: profession
+    "Based on your data, here's what we think what field you work in.",
+    # 7: top 3 topics
+    "Let's take a look at the top 3 topics you searched up this past year.",
+    # 8: topics per month
+    "Here's how what you've looked up on GPT has changed over the months.",
+    # 9: topics per hour
+    "And here's what topics you've looked up at each hour of the day.",
+    # 10: outro
+    "Placeholder.",
+)
+
 async def transcribe_insight(user_id: str, insight: object, page_index: int):
-    match page_index:
-        case -1:
-            # intro
-            text = "Hey, it's your favorite AI company CEO. Welcome to GPT Rewind! Let's take a look at what you have here..."
-        case 0:
-            # total hours
-            text = "Here's the total amount of time you spent on GPT this year. Hopefully you used that time wisely. But if you didn't... don't worry. Your secret is safe with us."
-        case 1:
-            # total hours by month
-            text = "And here's the amount of hours you spent grouped by month. Looks like [month] was your biggest month!"
-        case 2:
-            # total hours grouped by hour/frequency of hours
-            text = "Let's take a look at what times of the day you used GPT the most."
-        case 3:
-            # longest conversation duration
-            text = "Here's the longest time you spent conversing with GPT. [hour] hours! I wonder what you were doing then."
-        case 4:
-            # easiest question
-            text = "Here's the easiest question you asked this year. Don't worry, we all have that moment sometimes."
-        case 5:
-            # hardest question
-            text = "And here's the hardest question you asked."
-        case 6:
-            # profession
-            text = "Based on your data, here's what we think what field you work in."
-        case 7:
-            # top 3 topics
-            text = "Let's take a look at the top 3 topics you searched up this past year."
-        case 8:
-            # topics per month
-            text = "Here's how what you've looked up on GPT has changed over the months."
-        case 9:
-            # topics per hour 
-            text = "And here's what topics you've looked up at each hour of the day."
-        case 10:
-            # outro
-            text = "Placeholder."
-        case _:
-            # Default case for any other page_index
-            return None
+    if not -1 <= page_index <= 10:
+        return None
+    text = _PAGE_TEXTS[page_index + 1]
     
     await transcribe_literal(user_id=user_id, text=text, page_index=page_index)
     return text
 
 
+async def transcribe_all(user_id: str):
+    """Generate narration audio for every page, MAX_CONCURRENT_TTS pages at a time."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_TTS)
+    
+    async def transcribe_page(page_index: int):
+        async with semaphore:
+            await transcribe_literal(user_id=user_id, text=_PAGE_TEXTS[page_index + 1], page_index=page_index)
+    
+    page_indices = range(-1, len(_PAGE_TEXTS) - 1)
+    await asyncio.gather(*(transcribe_page(page_index) for page_index in page_indices))
+    return list(_PAGE_TEXTS)
+
+
 async def transcribe_literal(user_id: str, text: str, page_index: int):
+    # The Fish Audio client is blocking; run it in a thread so concurrent
+    # transcriptions actually overlap instead of serializing the event loop
+    await asyncio.to_thread(_transcribe_literal_sync, user_id, text, page_index)
+
+
+def _transcribe_literal_sync(user_id: str, text: str, page_index: int):
     client = FishAudio(api_key=FISH_AUDIO_API_KEY)
     audio = client.tts.convert(text = text, reference_id = REFERENCE_ID)
     output_dir = os.path.join("output_files", user_id, "sounds")
@@ -4,6 +4,7 @@ ML package for GPT Rewind
 Contains modules for:
 - conversation_compression: Process and compress ChatGPT conversation exports
 - embeddings: Generate embeddings using GTE-Large model
+- embedding_store: Float16 .npy side-file storage for embedding vectors
 - question_analytics: Analyze question difficulty and topics
 - pipeline: Unified interface for running the complete ML pipeline
 """
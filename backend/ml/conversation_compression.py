@@ -18,12 +18,20 @@ import json
 import re
 from datetime import datetime, timedelta
 from collections import defaultdict
+from functools import lru_cache
 from multiprocessing import Pool, cpu_count
-from typing import Dict, List, Tuple, Any
+from typing import Dict, List, Tuple, Any, NamedTuple
 import sys
 
+# Try to import orjson for faster JSON decoding/encoding (optional)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 # Common English stopwords
-STOPWORDS = {
+STOPWORDS = frozenset({
     'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're",
     "you've", "you'll", "you'd", 'your', 'yours', 'yourself', 'yourselves', 'he',
     'him', 'his', 'himself', 'she', "she's", 'her', 'hers', 'herself', 'it', "it's",
@@ -43,10 +51,16 @@ STOPWORDS = {
     "haven't", 'isn', "isn't", 'ma', 'mightn', "mightn't", 'mustn', "mustn't",
     'needn', "needn't", 'shan', "shan't", 'shouldn', "shouldn't", 'wasn', "wasn't",
     'weren', "weren't", 'won', "won't", 'wouldn', "wouldn't"
-}
+})
+
+# Tokens of 2 characters or fewer are always dropped by clean_content, so the
+# tokenizer never emits them and the membership test only needs longer words
+_WORD_RE = re.compile(r'\b[a-z]{3,}\b')
+_LONG_STOPWORDS = frozenset(w for w in STOPWORDS if len(w) > 2)
 
 # Configuration
 IDLE_THRESHOLD_MINUTES = 30
+MAX_TIMESTAMP = 32503680000.0  # 3000-01-01; later timestamps are rejected as corrupt
 MIN_SESSION_DURATION_MINUTES = 0
 LAST_MESSAGE_PADDING_MINUTES = 10
 
@@ -57,6 +71,18 @@ DEVELOPMENT_COST_PER_HOUR = 10.0
 TOTAL_INSTANCE_COST_PER_HOUR = GPU_COST_PER_HOUR + ELECTRICITY_COST_PER_HOUR + DEVELOPMENT_COST_PER_HOUR
 
 
+class Message(NamedTuple):
+    """
+    A single extracted message.
+    Tuple-backed, so it is much smaller than a dict and cheap to pickle to workers.
+    """
+    id: str
+    timestamp: float
+    role: str
+    content: str
+    conversation_id: str
+
+
 def clean_content(text: str) -> List[str]:
     """
     Clean message content by:
@@ -66,22 +92,36 @@ def clean_content(text: str) -> List[str]:
     if not text or not isinstance(text, str):
         return []
     
+    return list(_clean_content_cached(text))
+
+
+@lru_cache(maxsize=1 << 14)
+def _clean_content_cached(text: str) -> Tuple[str, ...]:
+    """
+    Cached core of clean_content. Exports repeat a lot of boilerplate turns,
+    so identical texts are only tokenized once. Returns a tuple so cached
+    results can't be mutated by callers.
+    """
     # Tokenize and remove stopwords from entire message
-    words = re.findall(r'\b[a-z]+\b', text.lower())
-    filtered_words = [w for w in words if w not in STOPWORDS and len(w) > 2]
+    words = _WORD_RE.findall(text.lower())
+    filtered_words = [w for w in words if w not in _LONG_STOPWORDS]
     
     if filtered_words:
-        return [' '.join(filtered_words)]
+        return (' '.join(filtered_words),)
     
-    return []
+    return ()
 
 
-def extract_messages_from_conversation(conv: Dict[str, Any]) -> List[Dict[str, Any]]:
+def extract_messages_from_conversation(conv: Dict[str, Any], cutoff_ts: float = 0.0) -> List[Message]:
     """
     Extract all messages from a conversation mapping structure.
     Includes unique message IDs based on node IDs.
+    Only messages with cutoff_ts <= create_time <= MAX_TIMESTAMP are kept,
+    and they are rejected before any content work is done. Every kept
+    timestamp is safe to pass to datetime.fromtimestamp.
     """
     messages = []
+    append = messages.append
     mapping = conv.get('mapping', {})
     conv_id = conv.get('id', 'unknown')
     
@@ -92,7 +132,7 @@ def extract_messages_from_conversation(conv: Dict[str, Any]) -> List[Dict[str, A
         
         # Get timestamp
         create_time = message.get('create_time')
-        if not create_time:
+        if not create_time or not (cutoff_ts <= create_time <= MAX_TIMESTAMP):
             continue
         
         # Get content
@@ -100,7 +140,12 @@ def extract_messages_from_conversation(conv: Dict[str, Any]) -> List[Dict[str, A
         if isinstance(content, dict):
             parts = content.get('parts', [])
             if parts and isinstance(parts, list):
-                text = ' '.join(str(p) for p in parts if p)
+                if len(parts) == 1:
+                    # Common case: a single text part, no join needed
+                    part = parts[0]
+                    text = part if isinstance(part, str) else (str(part) if part else '')
+                else:
+                    text = ' '.join(str(p) for p in parts if p)
             else:
                 text = ''
         else:
@@ -113,45 +158,30 @@ def extract_messages_from_conversation(conv: Dict[str, Any]) -> List[Dict[str, A
         # Create unique message ID: conv_id + node_id
         message_id = f"{conv_id}_{node_id}"
         
-        messages.append({
-            'id': message_id,
-            'timestamp': create_time,
-            'role': role,
-            'content': text,
-            'conversation_id': conv_id
-        })
+        append(Message(message_id, create_time, role, text, conv_id))
     
     return messages
 
 
+# The timestamp helpers below take timestamps that already passed the range
+# check in extract_messages_from_conversation, so they skip the try/except.
+
 def format_timestamp(ts: float) -> str:
     """Convert Unix timestamp to YYYY-MM-DD HH:MM:SS format."""
-    try:
-        dt = datetime.fromtimestamp(ts)
-        return dt.strftime('%Y-%m-%d %H:%M:%S')
-    except (ValueError, OSError):
-        return '1970-01-01 00:00:00'
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
 
 
 def get_month_bucket(ts: float) -> str:
     """Get month bucket in YYYY-MM format."""
-    try:
-        dt = datetime.fromtimestamp(ts)
-        return dt.strftime('%Y-%m')
-    except (ValueError, OSError):
-        return '1970-01'
+    return datetime.fromtimestamp(ts).strftime('%Y-%m')
 
 
 def get_hour_of_day(ts: float) -> int:
     """Get hour of day (0-23) from timestamp."""
-    try:
-        dt = datetime.fromtimestamp(ts)
-        return dt.hour
-    except (ValueError, OSError):
-        return 0
+    return datetime.fromtimestamp(ts).hour
 
 
-def calculate_active_duration(messages: List[Dict[str, Any]], idle_threshold_minutes: int = IDLE_THRESHOLD_MINUTES) -> float:
+def calculate_active_duration(messages: List[Message], idle_threshold_minutes: int = IDLE_THRESHOLD_MINUTES) -> float:
     """
     Calculate total active duration in hours for a list of messages.
     """
@@ -161,13 +191,13 @@ def calculate_active_duration(messages: List[Dict[str, Any]], idle_threshold_min
     if len(messages) == 1:
         return (MIN_SESSION_DURATION_MINUTES + LAST_MESSAGE_PADDING_MINUTES) / 60.0
     
-    sorted_msgs = sorted(messages, key=lambda x: x['timestamp'])
+    sorted_msgs = sorted(messages, key=lambda x: x.timestamp)
     sessions = []
     current_session = [sorted_msgs[0]]
     idle_threshold_seconds = idle_threshold_minutes * 60
     
     for i in range(1, len(sorted_msgs)):
-        time_diff = sorted_msgs[i]['timestamp'] - sorted_msgs[i - 1]['timestamp']
+        time_diff = sorted_msgs[i].timestamp - sorted_msgs[i - 1].timestamp
         
         if time_diff <= idle_threshold_seconds:
             current_session.append(sorted_msgs[i])
@@ -184,41 +214,33 @@ def calculate_active_duration(messages: List[Dict[str, Any]], idle_threshold_min
         if len(session) == 1:
             total_duration_seconds += (MIN_SESSION_DURATION_MINUTES * 60) + padding_seconds
         else:
-            session_duration = session[-1]['timestamp'] - session[0]['timestamp']
+            session_duration = session[-1].timestamp - session[0].timestamp
             total_duration_seconds += session_duration + padding_seconds
     
     return total_duration_seconds / 3600.0
 
 
-def get_conversation_duration(messages: List[Dict[str, Any]]) -> float:
+def get_conversation_duration(messages: List[Message]) -> float:
     """Get duration in hours for a conversation."""
     if not messages:
         return 0.0
     return calculate_active_duration(messages)
 
 
-def process_conversation(conv: Dict[str, Any], cutoff_date: datetime) -> Tuple[str, List[Dict[str, Any]]]:
+def process_conversation(conv: Dict[str, Any], cutoff_date: datetime) -> Tuple[str, List[Message]]:
     """
     Process a single conversation and return its ID and filtered messages.
     Returns (conv_id, messages_list)
     """
     conv_id = conv.get('id', 'unknown')
-    messages = extract_messages_from_conversation(conv)
-    
-    # Filter messages within the last 12 months
-    filtered_messages = []
-    for msg in messages:
-        try:
-            msg_dt = datetime.fromtimestamp(msg['timestamp'])
-            if msg_dt >= cutoff_date:
-                filtered_messages.append(msg)
-        except (ValueError, OSError):
-            continue
+    
+    # Filter messages within the last 12 months on the raw timestamp
+    filtered_messages = extract_messages_from_conversation(conv, cutoff_date.timestamp())
     
     return (conv_id, filtered_messages)
 
 
-def process_month_data(args: Tuple[str, List[Tuple[str, List[Dict[str, Any]]]]]) -> Tuple[str, Dict[str, Any]]:
+def process_month_data(args: Tuple[str, List[Tuple[str, List[Message]]]]) -> Tuple[str, Dict[str, Any]]:
     """
     Process all conversations for a specific month.
     """
@@ -244,19 +266,19 @@ def process_month_data(args: Tuple[str, List[Tuple[str, List[Dict[str, Any]]]]])
             longest_conv_id = conv_id
         
         for msg in messages:
-            hour = get_hour_of_day(msg['timestamp'])
+            hour = get_hour_of_day(msg.timestamp)
             hourly_distribution[hour] += 1
         
         # Process messages for this conversation
         conversation_messages = []
         for msg in messages:
-            cleaned_content = clean_content(msg['content'])
+            cleaned_content = clean_content(msg.content)
             if cleaned_content:
                 conversation_messages.append({
-                    'id': msg['id'],  # Include message ID
-                    'timestamp': format_timestamp(msg['timestamp']),
-                    'role': msg['role'],
-                    'content': msg['content'],  # Keep raw content
+                    'id': msg.id,  # Include message ID
+                    'timestamp': format_timestamp(msg.timestamp),
+                    'role': msg.role,
+                    'content': msg.content,  # Keep raw content
                     'cleaned_content': cleaned_content
                 })
         
@@ -348,7 +370,7 @@ def consolidate_analytics(month_results: List[Tuple[str, Dict[str, Any]]]) -> Di
     return analytics
 
 
-def create_conversations_with_msg_id(all_conversation_data: List[Tuple[str, List[Dict[str, Any]]]]) -> Dict[str, Any]:
+def create_conversations_with_msg_id(all_conversation_data: List[Tuple[str, List[Message]]]) -> Dict[str, Any]:
     """
     Create conversations_with_msg_id structure: messages grouped by month only (flattened).
     
@@ -363,12 +385,12 @@ def create_conversations_with_msg_id(all_conversation_data: List[Tuple[str, List
     
     for conv_id, messages in all_conversation_data:
         for msg in messages:
-            month = get_month_bucket(msg['timestamp'])
+            month = get_month_bucket(msg.timestamp)
             messages_by_month[month].append({
-                'id': msg['id'],
-                'timestamp': format_timestamp(msg['timestamp']),
-                'role': msg['role'],
-                'content': msg['content'],
+                'id': msg.id,
+                'timestamp': format_timestamp(msg.timestamp),
+                'role': msg.role,
+                'content': msg.content,
                 'conversation_id': conv_id
             })
     
@@ -377,6 +399,74 @@ def create_conversations_with_msg_id(all_conversation_data: List[Tuple[str, List
         messages_by_month[month].sort(key=lambda x: x['timestamp'])
     
     return dict(messages_by_month)
+
+
+def load_json(path: str) -> Any:
+    """Load a JSON file, using orjson when available."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if ORJSON_AVAILABLE:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def encode_json(value: Any) -> bytes:
+    """Encode a value as compact UTF-8 JSON, using orjson when available."""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+
+class JsonStreamWriter:
+    """
+    Minimal streaming JSON writer for a binary file.
+    Emits object punctuation itself and encodes each value separately, so
+    the whole document never exists in memory as a single string.
+    """
+    
+    def __init__(self, f):
+        self._f = f
+        self._has_items: List[bool] = []
+    
+    def _separator(self):
+        if self._has_items:
+            if self._has_items[-1]:
+                self._f.write(b',')
+            self._has_items[-1] = True
+    
+    def _key(self, key: str):
+        self._separator()
+        self._f.write(encode_json(key) + b':')
+    
+    def begin_object(self, key: str = None):
+        """Open an object, either at the top level or as the value of `key`."""
+        if key is not None:
+            self._key(key)
+        else:
+            self._separator()
+        self._f.write(b'{')
+        self._has_items.append(False)
+    
+    def end_object(self):
+        self._has_items.pop()
+        self._f.write(b'}')
+    
+    def write_item(self, key: str, value: Any):
+        self._key(key)
+        self._f.write(encode_json(value))
+
+
+def write_compressed_output(output_file: str, metadata: Dict[str, Any], by_month: Dict[str, Any]):
+    """Stream the compressed conversations file one month bucket at a time."""
+    with open(output_file, 'wb') as f:
+        writer = JsonStreamWriter(f)
+        writer.begin_object()
+        writer.write_item('metadata', metadata)
+        writer.begin_object('by_month')
+        for month, conversations in by_month.items():
+            writer.write_item(month, conversations)
+        writer.end_object()
+        writer.end_object()
 import os
 
 def process_conversations(input_file: str, output_dir: str = '.'):
@@ -401,8 +491,7 @@ def process_conversations(input_file: str, output_dir: str = '.'):
     # Load conversations
     try:
         print(f"\nLoading {input_file}...")
-        with open(input_file, 'r', encoding='utf-8') as f:
-            conversations = json.load(f)
+        conversations = load_json(input_file)
         print(f"Loaded {len(conversations)} conversations")
     except FileNotFoundError:
         print(f"Error: {input_file} not found!")
@@ -466,7 +555,7 @@ def process_conversations(input_file: str, output_dir: str = '.'):
         month_messages = defaultdict(list)
         
         for msg in messages:
-            month = get_month_bucket(msg['timestamp'])
+            month = get_month_bucket(msg.timestamp)
             month_messages[month].append(msg)
         
         for month, msgs in month_messages.items():
@@ -496,15 +585,11 @@ def process_conversations(input_file: str, output_dir: str = '.'):
     compressed_file = os.path.join(output_dir, 'compressed_conversations.json')
     print(f"\nWriting compressed conversations to {compressed_file}...")
     
-    with open(compressed_file, 'w', encoding='utf-8') as f:
-        json.dump({
-            'metadata': {
-                'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'cutoff_date': cutoff_date.strftime('%Y-%m-%d'),
-                'total_months': len(by_month)
-            },
-            'by_month': by_month
-        }, f, indent=2, ensure_ascii=False)
+    write_compressed_output(compressed_file, {
+        'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'cutoff_date': cutoff_date.strftime('%Y-%m-%d'),
+        'total_months': len(by_month)
+    }, by_month)
     print(f"✓ Saved {compressed_file}")
     
     # Step 7: Save analytics
@@ -535,8 +620,7 @@ def main():
     input_file = 'conversations.json'
     try:
         print(f"\nLoading {input_file}...")
-        with open(input_file, 'r', encoding='utf-8') as f:
-            conversations = json.load(f)
+        conversations = load_json(input_file)
         print(f"Loaded {len(conversations)} conversations")
     except FileNotFoundError:
         print(f"Error: {input_file} not found!")
@@ -595,7 +679,7 @@ def main():
         month_messages = defaultdict(list)
         
         for msg in messages:
-            month = get_month_bucket(msg['timestamp'])
+            month = get_month_bucket(msg.timestamp)
             month_messages[month].append(msg)
         
         for month, msgs in month_messages.items():
@@ -621,25 +705,21 @@ def main():
     
     analytics = consolidate_analytics(month_results)
     
-    # Step 6: Create compressed output
-    output = {
-        'metadata': {
-            'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'cutoff_date': cutoff_date.strftime('%Y-%m-%d'),
-            'total_conversations': len(all_conversation_data),
-            'months_covered': len(by_month),
-            'idle_threshold_minutes': IDLE_THRESHOLD_MINUTES,
-            'note': 'Compressed output with cleaned content and message IDs'
-        },
-        'by_month': by_month
+    # Step 6: Create compressed output metadata
+    metadata = {
+        'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'cutoff_date': cutoff_date.strftime('%Y-%m-%d'),
+        'total_conversations': len(all_conversation_data),
+        'months_covered': len(by_month),
+        'idle_threshold_minutes': IDLE_THRESHOLD_MINUTES,
+        'note': 'Compressed output with cleaned content and message IDs'
     }
     
-    # Step 7: Write compressed output
+    # Step 7: Stream compressed output
     output_file = 'compressed_conversations.json'
     print(f"\nWriting compressed output to {output_file}...")
     
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(output, f, indent=2, ensure_ascii=False)
+    write_compressed_output(output_file, metadata, by_month)
     print(f"✓ Saved {output_file}")
     
     # Step 8: Write analytics output
@@ -0,0 +1,108 @@
+"""
+Binary side-file storage for message embeddings.
+
+Embedding vectors are not stored inline in embedded_conversations.json.
+They are written to a float16 .npy file (embeddings.fp16.npy) next to it,
+and each message's 'embeddings' list holds integer row indices into that
+file (None for content parts that were not embedded). The metadata block records the
+file name and dtype.
+
+Optionally the vectors are quantized to int8 with one float16 scale per
+row (embeddings.int8.npy + embedding_scales.npy), half the size of float16.
+load_embedding_matrix hides the difference from readers.
+"""
+
+import os
+import numpy as np
+from typing import Dict, Any, Optional
+
+EMBEDDING_FILE_NAME = 'embeddings.fp16.npy'
+EMBEDDING_DTYPE = np.float16
+
+QUANTIZED_FILE_NAME = 'embeddings.int8.npy'
+SCALE_FILE_NAME = 'embedding_scales.npy'
+QUANTIZE_CHUNK_ROWS = 65536  # Bounds the float32 temporaries while quantizing
+
+
+class QuantizedMatrix:
+    """
+    Read-only view of an int8 embedding matrix with per-row scales.
+    Indexing rows returns them dequantized to float32.
+    """
+
+    def __init__(self, values: np.ndarray, scales: np.ndarray):
+        self.values = values
+        self.scales = scales
+        self.shape = values.shape
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, rows) -> np.ndarray:
+        return self.values[rows].astype(np.float32) * self.scales[rows].astype(np.float32)
+
+
+def quantize_embeddings(matrix: np.ndarray) -> tuple:
+    """
+    Quantize rows to int8 with a symmetric per-row scale (max |x| / 127).
+    Returns (values int8 [N, D], scales float16 [N, 1]).
+    """
+    values = np.empty(matrix.shape, dtype=np.int8)
+    scales = np.empty((matrix.shape[0], 1), dtype=np.float16)
+    for start in range(0, matrix.shape[0], QUANTIZE_CHUNK_ROWS):
+        block = np.asarray(matrix[start:start + QUANTIZE_CHUNK_ROWS], dtype=np.float32)
+        scale = np.abs(block).max(axis=1, keepdims=True) / 127
+        scale[scale == 0] = 1.0  # All-zero rows stay zero
+        values[start:start + len(block)] = np.clip(np.rint(block / scale), -127, 127)
+        scales[start:start + len(block)] = scale
+    return values, scales
+
+
+def save_embedding_matrix(output_file: str, matrix: np.ndarray, metadata: Dict[str, Any], quantize: bool = False) -> str:
+    """
+    Save the embedding matrix next to output_file and record it in metadata.
+    With quantize=True the rows are stored as int8 plus per-row scales.
+    Returns the path of the written .npy file.
+    """
+    output_dir = os.path.dirname(output_file)
+    metadata['embedding_shape'] = list(matrix.shape)
+
+    if quantize:
+        values, scales = quantize_embeddings(matrix)
+        path = os.path.join(output_dir, QUANTIZED_FILE_NAME)
+        np.save(path, values)
+        np.save(os.path.join(output_dir, SCALE_FILE_NAME), scales)
+        metadata['embedding_file'] = QUANTIZED_FILE_NAME
+        metadata['embedding_dtype'] = 'int8'
+        metadata['embedding_scale_file'] = SCALE_FILE_NAME
+        return path
+
+    matrix = np.asarray(matrix, dtype=EMBEDDING_DTYPE)
+    path = os.path.join(output_dir, EMBEDDING_FILE_NAME)
+    np.save(path, matrix)
+
+    metadata['embedding_file'] = EMBEDDING_FILE_NAME
+    metadata['embedding_dtype'] = str(matrix.dtype)
+    return path
+
+
+def load_embedding_matrix(embed_file: str, metadata: Dict[str, Any]):
+    """
+    Memory-map the embedding matrix referenced by an embedded JSON's metadata.
+    Rows are only read from disk when they are indexed. An int8 matrix is
+    returned as a QuantizedMatrix, which dequantizes the rows it is indexed with.
+    """
+    base_dir = os.path.dirname(embed_file)
+    values = np.load(os.path.join(base_dir, metadata.get('embedding_file', EMBEDDING_FILE_NAME)), mmap_mode='r')
+    if metadata.get('embedding_dtype') == 'int8':
+        scales = np.load(os.path.join(base_dir, metadata['embedding_scale_file']), mmap_mode='r')
+        return QuantizedMatrix(values, scales)
+    return values
+
+
+def first_embedding_row(msg: Dict[str, Any]) -> Optional[int]:
+    """Row index of the first embedded content part of a message, or None."""
+    for row in msg.get('embeddings') or ():
+        if row is not None:
+            return row
+    return None
@@ -4,37 +4,136 @@ ChatGPT Conversation Embedding Generator using GTE-Large (OPTIMIZED)
 
 Optimizations:
 - torch.inference_mode() for faster inference
-- Mixed precision (float16) on GPU
+- Mixed precision (bfloat16/float16) on GPU
 - Reduced CPU/GPU synchronization
 - Minimal printing and progress updates
 - Pre-allocated tensors where possible
 - Efficient batch processing
 - Preserves message IDs throughout processing
+- Vectors stored in a float16 .npy side file, indexed by row from the JSON
 """
 
+import os
+
+# The CUDA caching allocator reads this on first use, so set it before torch
+# is imported. Expandable segments stop batches of varying padded length
+# from fragmenting reserved memory into blocks too small to reuse.
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:256')
+# Let the Rust tokenizer use all cores for the single up-front batch call
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'true')
+
 import json
+import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import Tensor
 from transformers import AutoTokenizer, AutoModel
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, NamedTuple
 import sys
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from contextlib import nullcontext
+from itertools import chain
 from datetime import datetime
 
+from ml.embedding_store import save_embedding_matrix, load_embedding_matrix
+
+# Try to import orjson for faster JSON loading/saving (optional)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Try to import the SDPA backend selector (PyTorch >= 2.3, optional)
+try:
+    from torch.nn.attention import sdpa_kernel, SDPBackend
+    SDPA_KERNEL_AVAILABLE = True
+except ImportError:
+    SDPA_KERNEL_AVAILABLE = False
+
+
+# Padded sequence lengths used on GPU. Each (rows, length) shape is compiled
+# and captured as its own CUDA graph, so a handful of buckets keeps the number
+# of graphs small.
+SEQ_BUCKETS = (64, 128, 256, 512)
+
+# Return cached-but-free GPU blocks every N batches on long runs (this syncs
+# the device, so it is kept infrequent)
+EMPTY_CACHE_EVERY = 64
+
+# Upper bound for the autotuned per-batch token budget on GPU
+MAX_TOKEN_BUDGET = 1 << 20
+
+# Fraction of the largest measured batch that is actually used: the probe
+# runs on the eager model, before CUDA-graph pools and prefetched batches
+# take their share of GPU memory
+AUTOTUNE_SAFETY = 0.75
+
+# Share of GPU memory the command-line run caps itself to, leaving headroom
+# for other processes on the same GPU. The cap is process-wide, so library
+# callers (e.g. the server pipeline) don't set it unless they ask to.
+CLI_MEMORY_FRACTION = 0.9
+
+
+def load_json(path: str) -> Any:
+    """Load a JSON file, using orjson when available."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if ORJSON_AVAILABLE:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _json_default(value: Any) -> Any:
+    """Convert NumPy values the JSON encoder does not handle natively."""
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def save_json(path: str, value: Any):
+    """
+    Write compact UTF-8 JSON (machine-read, so no indentation), using orjson
+    when available. NumPy arrays and scalars are serialized natively.
+    """
+    if ORJSON_AVAILABLE:
+        data = orjson.dumps(value, default=_json_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    else:
+        data = json.dumps(value, ensure_ascii=False, default=_json_default).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(data)
+
 
 def average_pool(last_hidden_states: Tensor, attention_mask: Tensor) -> Tensor:
-    """Average pooling over token embeddings."""
-    last_hidden = last_hidden_states.masked_fill(~attention_mask[..., None].bool(), 0.0)
-    return last_hidden.sum(dim=1) / attention_mask.sum(dim=1)[..., None]
+    """
+    Average pooling over token embeddings.
+    The 0/1 mask is applied and summed in one batched matmul:
+    (B, 1, L) @ (B, L, H) -> (B, 1, H).
+    """
+    mask = attention_mask.to(last_hidden_states.dtype)
+    summed = (mask.unsqueeze(1) @ last_hidden_states).squeeze(1)
+    return summed / mask.sum(dim=1, keepdim=True)
 
 
 class GTELargeGenerator:
     """Wrapper for GTE-Large model with GPU acceleration and optimization."""
     
-    def __init__(self, model_name: str = "thenlper/gte-large", max_length: int = 512):
-        """Initialize GTE-Large model with optimizations."""
+    def __init__(self, model_name: str = "thenlper/gte-large", max_length: int = 512,
+                 memory_fraction: Optional[float] = None):
+        """
+        Initialize GTE-Large model with optimizations.
+        
+        memory_fraction caps this process's share of GPU memory (process-wide
+        and permanent); None leaves the allocator uncapped.
+        """
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.use_amp = self.device == 'cuda'  # Use mixed precision on GPU
+        # Prefer bfloat16 (same range as float32) where the GPU supports it
+        if self.use_amp:
+            self.dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        else:
+            self.dtype = torch.float32
+        self.precision = str(self.dtype).replace('torch.', '')
         
         print(f"Device: {self.device}", end='')
         if self.device == 'cuda':
@@ -42,170 +141,509 @@ class GTELargeGenerator:
         else:
             print()
         
-        # Load tokenizer and model
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModel.from_pretrained(model_name)
+        # Load tokenizer and model directly in the inference dtype, using
+        # PyTorch's fused scaled_dot_product_attention kernels
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        self.model = AutoModel.from_pretrained(
+            model_name,
+            attn_implementation="sdpa",
+            dtype=self.dtype
+        )
         
         if self.device == 'cuda':
-            self.model = self.model.cuda()
-            # Convert to float16 for faster inference
-            self.model = self.model.half()
+            self.model = self.model.to(self.device)
+            if memory_fraction is not None:
+                torch.cuda.set_per_process_memory_fraction(memory_fraction)
+            # TF32 for any remaining float32 matmuls (e.g. pooling) on Ampere+
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
         
         self.model.eval()
+        self.model.requires_grad_(False)
         self.max_length = max_length
+        self.embedding_dim = self.model.config.hidden_size
+        
+        # Cap on padded tokens per batch (batch rows x padded length), measured
+        # on the eager model before compilation
+        self.max_tokens = self._autotune_max_tokens() if self.device == 'cuda' else None
+        
+        # Compile the forward on GPU ('reduce-overhead' replays CUDA graphs).
+        # Static shapes keep one graph per batch shape, so batches are padded
+        # up to a SEQ_BUCKETS length. With the token budget, rows are then
+        # fixed per bucket too, apart from one final partial batch per bucket.
+        self.seq_buckets = None
+        if self.device == 'cuda' and hasattr(torch, 'compile'):
+            self.model = torch.compile(self.model, mode='reduce-overhead', dynamic=False)
+            self.seq_buckets = sorted({min(b, max_length) for b in SEQ_BUCKETS} | {max_length})
+            # Full + partial batch shape per bucket, without falling back to eager
+            dynamo_config = torch._dynamo.config
+            limit_name = 'recompile_limit' if hasattr(dynamo_config, 'recompile_limit') else 'cache_size_limit'
+            setattr(dynamo_config, limit_name, max(getattr(dynamo_config, limit_name), 2 * len(self.seq_buckets)))
+        
+        # Side stream for host-to-device copies so they overlap with compute
+        self.copy_stream = torch.cuda.Stream() if self.device == 'cuda' else None
     
-    def encode(self, texts: List[str], batch_size: int = 32) -> List[List[float]]:
+    def _autotune_max_tokens(self) -> int:
         """
-        Encode texts with optimized inference.
+        Find the per-batch token budget by running full-length (max_length)
+        dummy batches of 1, 2, 4, ... rows until the GPU runs out of memory,
+        then keeping AUTOTUNE_SAFETY of the last size that fit. With SDPA
+        attention, activation memory grows with rows x padded length (no
+        L x L score matrix), so the result applies to shorter buckets as the
+        same token count. encode_tokenized still recovers from an OOM.
+        """
+        length = self.max_length
+        token_id = self.tokenizer.cls_token_id or 0
+        rows = 1
+        best = length  # A single full-length text must always fit
+        
+        with torch.inference_mode(), self._attention_context():
+            while rows * length <= MAX_TOKEN_BUDGET:
+                try:
+                    input_ids = torch.full((rows, length), token_id, dtype=torch.long, device=self.device)
+                    attention_mask = torch.ones_like(input_ids)
+                    outputs = self.model(input_ids=input_ids, attention_mask=attention_mask)
+                    average_pool(outputs.last_hidden_state, attention_mask)
+                    torch.cuda.synchronize()
+                except torch.cuda.OutOfMemoryError:
+                    break
+                finally:
+                    outputs = input_ids = attention_mask = None
+                best = rows * length
+                rows *= 2
+        
+        torch.cuda.empty_cache()
+        budget = max(length, int(best * AUTOTUNE_SAFETY) // length * length)
+        print(f"Autotuned batch budget: {budget:,} tokens ({budget // length} x {length}; largest fit {best // length} x {length})")
+        return budget
+    
+    def tokenize(self, texts: List[str]) -> tuple:
+        """
+        Tokenize all texts in a single call to the tokenizer (unpadded).
+        Batching the whole list lets the fast tokenizer amortize its dispatch
+        overhead instead of paying it once per batch.
+        """
+        if not texts:
+            return [], []
+        encoded = self.tokenizer(
+            texts,
+            max_length=self.max_length,
+            padding=False,
+            truncation=True,
+            return_attention_mask=True,
+            return_token_type_ids=False,  # BERT defaults to all-zero segment ids
+            return_tensors=None
+        )
+        return encoded['input_ids'], encoded['attention_mask']
+    
+    def _make_batches(self, lengths: List[int], batch_size: Optional[int], max_tokens: Optional[int]) -> List[tuple]:
+        """
+        Split texts (in order) into (start, end) batches of at most batch_size
+        texts whose padded size, rows x longest length, stays within max_tokens.
+        Either limit may be None. With length-sorted input, short texts share
+        large batches and long texts get small ones.
+        """
+        batches = []
+        start = 0
+        longest = 0
+        for i, length in enumerate(lengths):
+            padded = self._padded_length(max(longest, length))
+            if i > start and (i - start == batch_size or (max_tokens and (i - start + 1) * padded > max_tokens)):
+                batches.append((start, i))
+                start = i
+                longest = 0
+            longest = max(longest, length)
+        batches.append((start, len(lengths)))
+        return batches
+    
+    def _padded_length(self, length: int) -> int:
+        """Sequence length a batch whose longest member has `length` tokens is padded to."""
+        if self.seq_buckets is None:
+            return length
+        for bucket in self.seq_buckets:
+            if length <= bucket:
+                return bucket
+        return self.seq_buckets[-1]
+    
+    def _pad_batch(self, input_ids: List[List[int]], attention_mask: List[List[int]]) -> Dict[str, Tensor]:
+        """
+        Pad one pre-tokenized batch to its longest sequence, rounded up to a
+        SEQ_BUCKETS length on GPU (CPU tensors).
+        On GPU the tensors are also pinned, ready for an asynchronous copy.
+        Runs on the prefetch thread in encode.
+        """
+        batch_dict = self.tokenizer.pad(
+            {'input_ids': input_ids, 'attention_mask': attention_mask},
+            padding='max_length',
+            max_length=self._padded_length(max(len(ids) for ids in input_ids)),
+            return_tensors='pt'
+        )
+        if self.copy_stream is None:
+            return batch_dict
+        return {k: v.pin_memory() for k, v in batch_dict.items()}
+    
+    def _to_device(self, batch_dict: Dict[str, Tensor]) -> Dict[str, Tensor]:
+        """
+        Start moving a padded batch to the device. On GPU the copy is issued
+        from pinned memory on copy_stream, so it runs asynchronously.
+        """
+        if self.copy_stream is None:
+            return batch_dict
+        with torch.cuda.stream(self.copy_stream):
+            return {k: v.to(self.device, non_blocking=True) for k, v in batch_dict.items()}
+    
+    def _attention_context(self):
+        """
+        Restrict SDPA to the fused FlashAttention / memory-efficient kernels
+        on GPU (never the math fallback that materializes L x L scores).
+        Padded batches carry an attention mask, which rules out flash, so in
+        practice the memory-efficient kernel is used.
+        """
+        if self.device == 'cuda' and SDPA_KERNEL_AVAILABLE:
+            return sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+        return nullcontext()
+    
+    def _embed(self, batch_dict: Dict[str, Tensor]) -> Tensor:
+        """Normalized float16 embeddings (on the device) for one padded batch."""
+        # Weights are already in self.dtype, so no autocast context is needed
+        outputs = self.model(**batch_dict)
+        
+        # Pool in the model dtype (the matmul accumulates in float32),
+        # so the (B, L, H) hidden states are never upcast. Only the
+        # small (B, H) pooled result is normalized in float32.
+        embeddings = average_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
+        return F.normalize(embeddings.float(), p=2, dim=1).to(torch.float16)
+    
+    def _encode_halves(self, input_ids: List[List[int]], attention_mask: List[List[int]]) -> Tensor:
+        """
+        Recovery path for a batch that ran out of GPU memory: free cached
+        blocks and encode it as two halves, synchronously, halving again
+        for any half that still does not fit. A single text that does not
+        fit re-raises.
+        """
+        if len(input_ids) == 1:
+            raise torch.cuda.OutOfMemoryError(f"A single {len(input_ids[0])}-token text does not fit in GPU memory")
+        torch.cuda.empty_cache()
+        
+        mid = len(input_ids) // 2
+        parts = []
+        for j, k in ((0, mid), (mid, len(input_ids))):
+            batch_dict = {key: v.to(self.device) for key, v in self._pad_batch(input_ids[j:k], attention_mask[j:k]).items()}
+            try:
+                part = self._embed(batch_dict)
+            except torch.cuda.OutOfMemoryError:
+                part = None
+            batch_dict = None
+            # Outside the except block, so the failed forward's tensors are freed first
+            parts.append(part if part is not None else self._encode_halves(input_ids[j:k], attention_mask[j:k]))
+        return torch.cat(parts)
+    
+    def empty_output(self, num_texts: int) -> Tensor:
+        """Allocate a float16 CPU tensor for num_texts embeddings (pinned on GPU hosts)."""
+        return torch.empty((num_texts, self.embedding_dim), dtype=torch.float16, pin_memory=self.device == 'cuda')
+    
+    def encode(self, texts: List[str], batch_size: Optional[int] = 32, show_progress: bool = False, out: Optional[Tensor] = None, max_tokens: Optional[int] = None) -> np.ndarray:
+        """
+        Encode texts with optimized inference, one row per text in input order.
+        See encode_tokenized for the arguments.
+        """
+        input_ids, attention_mask = self.tokenize(texts)
+        return self.encode_tokenized(input_ids, attention_mask, batch_size=batch_size, show_progress=show_progress, out=out, max_tokens=max_tokens)
+    
+    def encode_tokenized(self, input_ids: List[List[int]], attention_mask: List[List[int]], batch_size: Optional[int] = 32, show_progress: bool = False, out: Optional[Tensor] = None, max_tokens: Optional[int] = None) -> np.ndarray:
+        """
+        Encode pre-tokenized (unpadded) texts from tokenize().
         
         Args:
-            texts: List of texts to encode
-            batch_size: Batch size for processing
+            input_ids, attention_mask: Token lists for each text, ideally
+                                       sorted by token count
+            batch_size: Maximum number of texts per batch (None: no limit,
+                        batches are sized by max_tokens alone)
+            max_tokens: Maximum padded tokens per batch; defaults to
+                        self.max_tokens (None means batch by count only)
+            show_progress: Print ~20 progress updates while encoding
+            out: Preallocated (num_texts, embedding_dim) float16 CPU tensor
+                 to fill; allocated with empty_output() if not given
         
         Returns:
-            List of normalized embedding vectors
+            float16 array of normalized embeddings, one row per text (a
+            NumPy view of out, so no copy is made)
         """
-        if not texts:
-            return []
+        total_texts = len(input_ids)
+        if out is None:
+            out = self.empty_output(total_texts)
+        if not total_texts:
+            return out.numpy()
         
-        all_embeddings = []
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+        batches = self._make_batches([len(ids) for ids in input_ids], batch_size, max_tokens)
         
-        # Use inference_mode for optimal performance
-        with torch.inference_mode():
+        total_batches = len(batches)
+        print_every = max(1, total_batches // 20)  # Print ~20 updates max
+        
+        def prepare(batch_idx: int) -> Dict[str, Tensor]:
+            j, k = batches[batch_idx]
+            return self._pad_batch(input_ids[j:k], attention_mask[j:k])
+        
+        # A single worker pads (and pins) upcoming batches while the model runs.
+        # One inference_mode context around the whole loop (no per-batch setup)
+        with ThreadPoolExecutor(max_workers=1) as prefetcher, torch.inference_mode(), self._attention_context():
+            next_batch = self._to_device(prepare(0))
+            pending = prefetcher.submit(prepare, 1) if total_batches > 1 else None
+            
             # Process in batches
-            for i in range(0, len(texts), batch_size):
-                batch_texts = texts[i:i + batch_size]
+            for batch_num, (start, end) in enumerate(batches, 1):
+                batch_dict = next_batch
+                
+                # Wait for this batch's copy, and tell the allocator its
+                # tensors are now used on the compute stream
+                if self.copy_stream is not None:
+                    compute_stream = torch.cuda.current_stream()
+                    compute_stream.wait_stream(self.copy_stream)
+                    for v in batch_dict.values():
+                        v.record_stream(compute_stream)
                 
-                # Tokenize
-                batch_dict = self.tokenizer(
-                    batch_texts,
-                    max_length=self.max_length,
-                    padding=True,
-                    truncation=True,
-                    return_tensors='pt'
-                )
+                try:
+                    embeddings = self._embed(batch_dict)
+                except torch.cuda.OutOfMemoryError:
+                    embeddings = None
                 
-                # Move to device
-                if self.device == 'cuda':
-                    batch_dict = {k: v.cuda() for k, v in batch_dict.items()}
+                if embeddings is None:
+                    # Out of memory: use half the budget for later calls and
+                    # redo this batch in halves rather than losing the run
+                    batch_dict = None
+                    if self.max_tokens:
+                        self.max_tokens = max(self.max_length, self.max_tokens // 2)
+                    print(f"  GPU out of memory on a {end - start}-text batch; retrying in halves "
+                          f"(token budget now {self.max_tokens})", flush=True)
+                    embeddings = self._encode_halves(input_ids[start:end], attention_mask[start:end])
                 
-                # Generate embeddings with mixed precision
-                if self.use_amp:
-                    with torch.autocast(device_type='cuda', dtype=torch.float16):
-                        outputs = self.model(**batch_dict)
-                        embeddings = average_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
-                else:
-                    outputs = self.model(**batch_dict)
-                    embeddings = average_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
+                # While the model runs this batch, copy the next one (already
+                # padded by the worker) and start padding the one after
+                if pending is not None:
+                    next_batch = self._to_device(pending.result())
+                    pending = prefetcher.submit(prepare, batch_num + 1) if batch_num + 1 < total_batches else None
                 
-                # Normalize embeddings (convert to float32 for precision)
-                embeddings = F.normalize(embeddings.float(), p=2, dim=1)
+                # Copy into this batch's slice of the output; from pinned
+                # memory this does not block the host
+                out[start:end].copy_(embeddings, non_blocking=True)
                 
-                # Convert to list - minimize CPU/GPU sync by batching this operation
-                batch_embeddings = embeddings.cpu().tolist()
-                all_embeddings.extend(batch_embeddings)
+                if self.device == 'cuda' and batch_num % EMPTY_CACHE_EVERY == 0:
+                    torch.cuda.empty_cache()
+                
+                # Minimal progress updates
+                if show_progress and (batch_num % print_every == 0 or batch_num == total_batches):
+                    print(f"  {end / total_texts * 100:.0f}% ({end:,}/{total_texts:,})", flush=True)
+        
+        # The only host/device sync: wait for the last device-to-host copies
+        # before handing out the array
+        if self.device == 'cuda':
+            torch.cuda.synchronize()
         
-        return all_embeddings
+        return out.numpy()
 
 
-def collect_all_texts_and_locations(compressed_data: Dict[str, Any]) -> tuple:
-    """Collect all text content and their locations in the data structure."""
+class Locations(NamedTuple):
+    """
+    Where each collected text lives, as parallel columns: msgs[i] is a direct
+    reference to the message dict and content_idx[i] the content part within
+    it, so embeddings can be written back without re-walking the tree.
+    """
+    msgs: List[Dict[str, Any]]
+    content_idx: np.ndarray
+
+
+def _collect_one(convs: Dict[str, Any]) -> tuple:
+    """
+    Collect texts, message references and content indices from one month's
+    conversations, as three parallel lists.
+    A message's 'embeddings' list (one None slot per content part) is created
+    when its first non-empty content part is found; messages without any
+    content are left untouched.
+    """
+    texts = []
+    msgs = []
+    content_indices = []
+    add_text = texts.append
+    add_msg = msgs.append
+    add_content_idx = content_indices.append
+    
+    # Flatten conversations -> message groups -> messages into one stream
+    for msg in chain.from_iterable(chain.from_iterable(convs.values())):
+        cleaned_content = msg.get('cleaned_content')
+        if not cleaned_content:
+            continue
+        for content_idx, content in enumerate(cleaned_content):
+            if content:
+                # Only initialize if not already present (preserve existing fields)
+                if 'embeddings' not in msg:
+                    msg['embeddings'] = [None] * len(cleaned_content)
+                add_text(content)
+                add_msg(msg)
+                add_content_idx(content_idx)
+    
+    return texts, msgs, content_indices
+
+
+def start_collecting(compressed_data: Dict[str, Any], executor: ThreadPoolExecutor) -> List[Future]:
+    """
+    Submit one collection task per month to executor.
+    Lets the traversal run while the model is loading on the main thread.
+    """
+    return [executor.submit(_collect_one, convs) for convs in compressed_data.get('by_month', {}).values()]
+
+
+def merge_collected(shards) -> tuple:
+    """Concatenate per-month results in month order into (texts, Locations)."""
     all_texts = []
-    all_locations = []
-    
-    # Collect from by_month
-    for month in compressed_data.get('by_month', {}).keys():
-        convs = compressed_data['by_month'][month]
-        for conv_id in convs.keys():
-            msg_groups = convs[conv_id]
-            for group_idx, msg_group in enumerate(msg_groups):
-                for msg_idx, msg in enumerate(msg_group):
-                    cleaned_content = msg.get('cleaned_content', [])
-                    for content_idx, content in enumerate(cleaned_content):
-                        if content:
-                            all_texts.append(content)
-                            all_locations.append({
-                                'month': month,
-                                'conv_id': conv_id,
-                                'group_idx': group_idx,
-                                'msg_idx': msg_idx,
-                                'content_idx': content_idx
-                            })
-    
-    return all_texts, all_locations
-
-
-def apply_embeddings_to_data(compressed_data: Dict[str, Any], locations: List[Dict], embeddings: List[List[float]]) -> Dict[str, Any]:
+    all_msgs = []
+    all_content_indices = []
+    for shard in shards:
+        texts, msgs, content_indices = shard.result() if isinstance(shard, Future) else shard
+        all_texts.extend(texts)
+        all_msgs.extend(msgs)
+        all_content_indices.extend(content_indices)
+    return all_texts, Locations(all_msgs, np.asarray(all_content_indices, dtype=np.uint32))
+
+
+def collect_all_texts_and_locations(compressed_data: Dict[str, Any]) -> tuple:
+    """
+    Collect all text content and their locations in the data structure.
+    Returns (all_texts, Locations) with one location per text.
     """
-    Apply generated embeddings back to the original data structure.
+    return merge_collected(_collect_one(convs) for convs in compressed_data.get('by_month', {}).values())
+
+
+def apply_embeddings_to_data(compressed_data: Dict[str, Any], locations: Locations, rows: np.ndarray) -> Dict[str, Any]:
+    """
+    Apply embedding row indices back to the original data structure.
+    Each slot stores the row of its vector in the embedding side file.
     Preserves all existing message fields including 'id', 'content', 'cleaned_content', etc.
     """
-    # Initialize embeddings field for all messages (preserve existing fields)
-    for month in compressed_data.get('by_month', {}).keys():
-        convs = compressed_data['by_month'][month]
-        for conv_id in convs.keys():
-            msg_groups = convs[conv_id]
-            for group_idx, msg_group in enumerate(msg_groups):
-                for msg_idx, msg in enumerate(msg_group):
-                    # Only initialize if not already present
-                    if 'embeddings' not in msg:
-                        msg['embeddings'] = [[] for _ in msg.get('cleaned_content', [])]
-    
-    # Apply embeddings using location information
-    for loc, embedding in zip(locations, embeddings):
-        msg = compressed_data['by_month'][loc['month']][loc['conv_id']][loc['group_idx']][loc['msg_idx']]
-        msg['embeddings'][loc['content_idx']] = embedding
+    for msg, content_idx, row in zip(locations.msgs, locations.content_idx.tolist(), rows.tolist()):
+        msg['embeddings'][content_idx] = row
     
     return compressed_data
 
 
-def process_compressed_data(compressed_data: Dict[str, Any], embedder: GTELargeGenerator, batch_size: int = 32) -> Dict[str, Any]:
-    """Process all compressed conversation data and add embeddings."""
-    # Collect all texts
-    all_texts, all_locations = collect_all_texts_and_locations(compressed_data)
-    total_texts = len(all_texts)
+def load_previous_embeddings(embed_file: str) -> Optional[tuple]:
+    """
+    Load a previous run's output for incremental mode.
+    Returns (text -> row, embedding_matrix), or None if there is no usable output.
+    """
+    if not os.path.exists(embed_file):
+        return None
+    previous = load_json(embed_file)
+    metadata = previous.get('metadata', {})
+    if 'embedding_file' not in metadata:
+        return None
+    
+    text_rows = {}
+    for convs in previous.get('by_month', {}).values():
+        for msg in chain.from_iterable(chain.from_iterable(convs.values())):
+            for text, row in zip(msg.get('cleaned_content') or (), msg.get('embeddings') or ()):
+                if row is not None:
+                    text_rows[text] = row
+    
+    return text_rows, load_embedding_matrix(embed_file, metadata)
+
+
+def process_compressed_data(compressed_data: Dict[str, Any], embedder: GTELargeGenerator, batch_size: Optional[int] = 32, collected: Optional[tuple] = None, previous: Optional[tuple] = None) -> tuple:
+    """
+    Process all compressed conversation data and add embeddings.
     
-    print(f"Text segments: {total_texts:,}")
-    print(f"Batch size: {batch_size}")
+    collected is an optional (texts, Locations) pair already gathered by
+    start_collecting/merge_collected; otherwise the data is walked here.
+    previous is an optional (text -> row, matrix) pair from
+    load_previous_embeddings; texts found there are not re-encoded.
     
-    # Generate embeddings in batches with minimal progress output
-    all_embeddings = []
-    total_batches = (total_texts + batch_size - 1) // batch_size
-    print_every = max(1, total_batches // 20)  # Print ~20 updates max
+    Returns (compressed_data, embedding_matrix): messages reference rows of
+    the float16 matrix, which holds one row per distinct text.
+    """
+    # Collect all texts
+    if collected is None:
+        collected = collect_all_texts_and_locations(compressed_data)
+    all_texts, all_locations = collected
+    total_texts = len(all_texts)
     
+    # Embed each distinct text only once; exports repeat many short strings
+    unique_index = {}
+    inverse = np.fromiter((unique_index.setdefault(text, len(unique_index)) for text in all_texts), dtype=np.intp, count=total_texts)
+    unique_texts = list(unique_index)
+    total_unique = len(unique_texts)
+    
+    print(f"Text segments: {total_texts:,} ({total_unique:,} unique)")
+    print(f"Batch size: {batch_size or 'unlimited'} (max {embedder.max_tokens or 'unlimited'} tokens per batch)")
+    
+    # Incremental mode: reuse vectors for texts a previous run already embedded.
+    # Keying by the exact text means edited content is always re-embedded.
+    pending = list(range(total_unique))
+    cached = []
+    cached_rows = []
+    if previous is not None:
+        previous_rows, previous_matrix = previous
+        pending = []
+        for i, text in enumerate(unique_texts):
+            row = previous_rows.get(text)
+            if row is None:
+                pending.append(i)
+            else:
+                cached.append(i)
+                cached_rows.append(row)
+        print(f"Reusing {len(cached):,} embeddings from the previous run; {len(pending):,} to encode")
+    
+    # Tokenize once, then sort by token count (longest first) so each batch
+    # pads to roughly its own longest member. Longest-first also puts the
+    # largest activations at the start, so an OOM shows up immediately.
+    print("Tokenizing...", flush=True)
+    input_ids, attention_mask = embedder.tokenize([unique_texts[i] for i in pending])
+    order = sorted(range(len(pending)), key=lambda i: len(input_ids[i]), reverse=True)
+    
+    # Generate embeddings straight into one preallocated float16 buffer
     print("Generating embeddings...", flush=True)
-    
-    for i in range(0, total_texts, batch_size):
-        batch_texts = all_texts[i:i + batch_size]
-        batch_num = (i // batch_size) + 1
-        
-        # Generate embeddings for batch
-        batch_embeddings = embedder.encode(batch_texts, batch_size=len(batch_texts))
-        all_embeddings.extend(batch_embeddings)
-        
-        # Minimal progress updates
-        if batch_num % print_every == 0 or batch_num == total_batches:
-            progress = (min(i + batch_size, total_texts) / total_texts) * 100
-            print(f"  {progress:.0f}% ({min(i + batch_size, total_texts):,}/{total_texts:,})", flush=True)
-    
-    # Apply embeddings back to data structure (preserves message IDs)
-    compressed_data = apply_embeddings_to_data(compressed_data, all_locations, all_embeddings)
-    
-    return compressed_data
-import os
+    embedding_matrix = embedder.encode_tokenized(
+        [input_ids[i] for i in order],
+        [attention_mask[i] for i in order],
+        batch_size=batch_size,
+        show_progress=True
+    )
+    
+    # Keep the matrix in encode order (no scatter copy): row r holds
+    # unique text pending[order[r]], so map each unique text to the row it
+    # landed in. Reused vectors are appended after the encoded ones.
+    row_of = np.empty(total_unique, dtype=np.intp)
+    row_of[np.asarray(pending, dtype=np.intp)[order]] = np.arange(len(pending))
+    if cached:
+        row_of[cached] = len(pending) + np.arange(len(cached))
+        reused = np.asarray(previous_matrix[np.asarray(cached_rows)], dtype=embedding_matrix.dtype)
+        embedding_matrix = np.concatenate([embedding_matrix, reused])
+    
+    # Every occurrence points at its text's row (preserves message IDs)
+    compressed_data = apply_embeddings_to_data(compressed_data, all_locations, row_of[inverse])
+    
+    return compressed_data, embedding_matrix
 
-def generate_embeddings(input_file: str, output_dir: str = '.'):
+
+def generate_embeddings(input_file: str, output_dir: str = '.', quantize: bool = False, incremental: bool = False,
+                        memory_fraction: Optional[float] = None):
     """
-    Wrapper function for pipeline integration.
     Generate embeddings for conversations using GTE-Large model.
+    Entry point for both pipeline integration and the command line (main).
     
     Args:
-        input_file: Path to conversations_with_msg_id.json
+        input_file: Path to compressed conversations JSON
         output_dir: Directory to write output file to
+        quantize: Store vectors as int8 with per-row scales instead of float16
+        incremental: Reuse vectors from an existing output in output_dir for
+                     texts that are unchanged, encoding only new ones
+        memory_fraction: Cap on this process's share of GPU memory (process-wide);
+                         None leaves it uncapped
     
     Returns:
         dict with:
         - output_file: Path to embedded conversations JSON
+        - embedding_file: Path to the float16 .npy file holding the vectors
         - num_messages: Number of messages embedded
         - duration_seconds: Time taken to generate embeddings
     """
@@ -213,54 +651,88 @@ def generate_embeddings(input_file: str, output_dir: str = '.'):
     print("Embedding Generator (GTE-Large) - OPTIMIZED")
     print("=" * 60)
     
-    # Load compressed data (actually using conversations_with_msg_id.json)
-    print(f"Loading {input_file}...", flush=True)
-    
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-    except FileNotFoundError:
+    # Check the input before the model starts loading, so a missing file
+    # fails fast
+    if not os.path.exists(input_file):
         print(f"Error: {input_file} not found!")
         raise FileNotFoundError(f"{input_file} not found. Please run conversation_compression.py first.")
-    except json.JSONDecodeError as e:
-        print(f"Error: Invalid JSON: {e}")
-        raise
     
-    # Verify message IDs are present
-    sample_checked = False
-    for month in list(data.get('by_month', {}).keys())[:1]:
-        for conv_id in list(data['by_month'][month].keys())[:1]:
-            for msg_group in data['by_month'][month][conv_id][:1]:
-                for msg in msg_group[:1]:
-                    if 'id' in msg:
-                        print(f"✓ Message IDs detected (sample: {msg['id'][:30]}...)")
-                        sample_checked = True
-                    else:
-                        print("⚠ Warning: No message IDs found in data")
-                    break
+    # Load the model on a background thread while the JSON is parsed
+    loader = ThreadPoolExecutor(max_workers=1)
+    model_future = loader.submit(GTELargeGenerator, max_length=512, memory_fraction=memory_fraction)
+    loader.shutdown(wait=False)
+    
+    collector = None
+    try:
+        # Load compressed data (actually using conversations_with_msg_id.json)
+        print(f"Loading {input_file}...", flush=True)
+        
+        try:
+            data = load_json(input_file)
+        except json.JSONDecodeError as e:
+            print(f"Error: Invalid JSON: {e}")
+            raise
+        
+        # Verify message IDs are present
+        sample_checked = False
+        for month in list(data.get('by_month', {}).keys())[:1]:
+            for conv_id in list(data['by_month'][month].keys())[:1]:
+                for msg_group in data['by_month'][month][conv_id][:1]:
+                    for msg in msg_group[:1]:
+                        if 'id' in msg:
+                            print(f"✓ Message IDs detected (sample: {msg['id'][:30]}...)")
+                            sample_checked = True
+                        else:
+                            print("⚠ Warning: No message IDs found in data")
+                        break
+                    if sample_checked:
+                        break
                 if sample_checked:
                     break
             if sample_checked:
                 break
-        if sample_checked:
-            break
-    
-    # Initialize embedder
-    try:
-        embedder = GTELargeGenerator(max_length=512)
-    except Exception as e:
-        print(f"Error initializing model: {e}")
+        
+        # Walk the conversations on worker threads while the model finishes loading
+        collector = ThreadPoolExecutor(max_workers=os.cpu_count())
+        shards = start_collecting(data, collector)
+        
+        # Incremental mode: index the previous output before it is overwritten
+        output_file = os.path.join(output_dir, 'embedded_conversations.json')
+        previous = load_previous_embeddings(output_file) if incremental else None
+        if incremental and previous is None:
+            print(f"No previous embeddings at {output_file}; embedding everything")
+        
+        # Wait for the embedder
+        try:
+            embedder = model_future.result()
+        except Exception as e:
+            print(f"Error initializing model: {e}")
+            raise
+    except BaseException:
+        # Don't leave the model loading on an orphaned thread: wait for it,
+        # drop it and hand its GPU memory back
+        if collector is not None:
+            collector.shutdown(cancel_futures=True)
+        if not model_future.cancel():
+            wait([model_future])
+        del model_future
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
         raise
     
-    # Configure batch size
-    batch_size = 256 if torch.cuda.is_available() else 32
+    # Configure batch size: on GPU the token budget alone sizes batches, so
+    # short texts are packed far beyond a fixed count
+    batch_size = None if embedder.max_tokens else 32
     
     # Process data
     start_time = datetime.now()
     print(f"\nStarted: {start_time.strftime('%H:%M:%S')}")
     print("-" * 60)
     
-    embedded_data = process_compressed_data(data, embedder, batch_size=batch_size)
+    collected = merge_collected(shards)
+    collector.shutdown()
+    embedded_data, embedding_matrix = process_compressed_data(data, embedder, batch_size=batch_size, collected=collected, previous=previous)
+    del previous  # Drop the memory map before the side file is rewritten
     
     end_time = datetime.now()
     duration = (end_time - start_time).total_seconds()
@@ -275,21 +747,22 @@ def generate_embeddings(input_file: str, output_dir: str = '.'):
     embedded_data['metadata']['embedding_device'] = embedder.device
     embedded_data['metadata']['embedding_duration_seconds'] = duration
     embedded_data['metadata']['embedding_batch_size'] = batch_size
+    embedded_data['metadata']['embedding_max_tokens'] = embedder.max_tokens
     embedded_data['metadata']['embedding_max_length'] = embedder.max_length
-    embedded_data['metadata']['embedding_precision'] = 'float16' if embedder.use_amp else 'float32'
+    embedded_data['metadata']['embedding_precision'] = embedder.precision
     
     # Save output
-    output_file = os.path.join(output_dir, 'embedded_conversations.json')
     print(f"\nSaving to {output_file}...", flush=True)
     
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(embedded_data, f, indent=2, ensure_ascii=False)
+    embedding_file = save_embedding_matrix(output_file, embedding_matrix, embedded_data['metadata'], quantize=quantize)
+    save_json(output_file, embedded_data)
     
     print("✓ Done")
     print("=" * 60)
     print(f"Model: GTE-Large | Device: {embedder.device}")
-    print(f"Precision: {'FP16' if embedder.use_amp else 'FP32'} | Batch: {batch_size}")
+    print(f"Precision: {embedder.precision.upper()} | Batch: {batch_size or f'{embedder.max_tokens} tokens'}")
     print(f"Time: {duration:.1f}s | Output: {output_file}")
+    print(f"Vectors: {embedding_file} ({os.path.getsize(embedding_file) / 1024 / 1024:.1f} MB)")
     print(f"Message IDs: Preserved ✓")
     print("=" * 60)
     
@@ -302,97 +775,26 @@ def generate_embeddings(input_file: str, output_dir: str = '.'):
     
     return {
         'output_file': output_file,
+        'embedding_file': embedding_file,
         'num_messages': total_messages,
         'duration_seconds': duration
     }
 
 
 def main():
-    print("=" * 60)
-    print("Embedding Generator (GTE-Large) - OPTIMIZED")
-    print("=" * 60)
-    
-    # Load compressed data
-    input_file = 'compressed_conversations.json'
-    print(f"Loading {input_file}...", flush=True)
-    
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            compressed_data = json.load(f)
-    except FileNotFoundError:
-        print(f"Error: {input_file} not found!")
-        sys.exit(1)
-    except json.JSONDecodeError as e:
-        print(f"Error: Invalid JSON: {e}")
-        sys.exit(1)
-    
-    # Verify message IDs are present
-    sample_checked = False
-    for month in list(compressed_data.get('by_month', {}).keys())[:1]:
-        for conv_id in list(compressed_data['by_month'][month].keys())[:1]:
-            for msg_group in compressed_data['by_month'][month][conv_id][:1]:
-                for msg in msg_group[:1]:
-                    if 'id' in msg:
-                        print(f"✓ Message IDs detected (sample: {msg['id'][:30]}...)")
-                        sample_checked = True
-                    else:
-                        print("⚠ Warning: No message IDs found in data")
-                    break
-                if sample_checked:
-                    break
-            if sample_checked:
-                break
-        if sample_checked:
-            break
+    # Usage: python -m ml.embeddings [input_file] [output_dir] [--int8] [--incremental]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    input_file = args[0] if len(args) > 0 else 'compressed_conversations.json'
+    output_dir = args[1] if len(args) > 1 else '.'
+    quantize = '--int8' in sys.argv
+    incremental = '--incremental' in sys.argv
     
-    # Initialize embedder
     try:
-        embedder = GTELargeGenerator(max_length=512)
-    except Exception as e:
-        print(f"Error initializing model: {e}")
+        generate_embeddings(input_file, output_dir, quantize=quantize, incremental=incremental,
+                            memory_fraction=CLI_MEMORY_FRACTION)
+    except (FileNotFoundError, json.JSONDecodeError):
         sys.exit(1)
-    
-    # Configure batch size
-    batch_size = 256 if torch.cuda.is_available() else 32
-    
-    # Process data
-    start_time = datetime.now()
-    print(f"\nStarted: {start_time.strftime('%H:%M:%S')}")
-    print("-" * 60)
-    
-    embedded_data = process_compressed_data(compressed_data, embedder, batch_size=batch_size)
-    
-    end_time = datetime.now()
-    duration = (end_time - start_time).total_seconds()
-    
-    print("-" * 60)
-    print(f"Completed: {end_time.strftime('%H:%M:%S')}")
-    print(f"Duration: {duration:.1f}s ({duration/60:.1f} min)")
-    
-    # Add embedding metadata
-    embedded_data['metadata']['embedding_model'] = 'thenlper/gte-large'
-    embedded_data['metadata']['embedding_generated_at'] = end_time.strftime('%Y-%m-%d %H:%M:%S')
-    embedded_data['metadata']['embedding_device'] = embedder.device
-    embedded_data['metadata']['embedding_duration_seconds'] = duration
-    embedded_data['metadata']['embedding_batch_size'] = batch_size
-    embedded_data['metadata']['embedding_max_length'] = embedder.max_length
-    embedded_data['metadata']['embedding_precision'] = 'float16' if embedder.use_amp else 'float32'
-    
-    # Save output
-    output_file = 'embedded_conversations.json'
-    print(f"\nSaving to {output_file}...", flush=True)
-    
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(embedded_data, f, indent=2, ensure_ascii=False)
-    
-    print("✓ Done")
-    print("=" * 60)
-    print(f"Model: GTE-Large | Device: {embedder.device}")
-    print(f"Precision: {'FP16' if embedder.use_amp else 'FP32'} | Batch: {batch_size}")
-    print(f"Time: {duration:.1f}s | Output: {output_file}")
-    print(f"Message IDs: Preserved ✓")
-    print("=" * 60)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -10,18 +10,55 @@ Author: Topic Discovery Pipeline
 Date: 2025-11-23
 """
 
+import os
+import gc
 import json
 import numpy as np
+from array import array
 from typing import Dict, List, Tuple, Any
 from collections import Counter, defaultdict
 from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 # Core libraries
-from scipy.spatial.distance import cosine
 import hdbscan
 import yake
 from joblib import Parallel, delayed
 
+from ml.embedding_store import load_embedding_matrix, first_embedding_row
+
+# Try to import orjson for faster JSON saving (optional)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Try to import ijson for streaming JSON parsing (optional)
+try:
+    import ijson
+    IJSON_AVAILABLE = True
+except ImportError:
+    IJSON_AVAILABLE = False
+
+# Try to import cuML for GPU HDBSCAN and UMAP (optional)
+try:
+    import cupy as cp
+    from cuml.cluster import HDBSCAN as cuHDBSCAN
+    from cuml.manifold import UMAP as cuUMAP
+    CUML_AVAILABLE = True
+except ImportError:
+    CUML_AVAILABLE = False
+
+# Try to import umap-learn for dimensionality reduction before clustering (optional)
+try:
+    import umap
+    import numba
+    UMAP_AVAILABLE = True
+except ImportError:
+    UMAP_AVAILABLE = False
+
 # For GTE-Large encoding
 import torch
 import torch.nn.functional as F
@@ -32,8 +69,26 @@ from transformers import AutoTokenizer, AutoModel
 # ============================================================================
 MAX_TEXT_INPUT = 500_000  # Truncate text passed to YAKE to 50k chars
 MIN_CLUSTER_SIZE = 5
+HDBSCAN_BATCH_SIZE = 3000  # Hours over PRECOMPUTED_MAX_N are clustered in random batches of about this size (keep it below the cap)
+HDBSCAN_BATCH_SEED = 0  # Fixed so batch assignment (and labels) are reproducible
 TOP_K_CLUSTERS = 3
+LABEL_FLUSH_HOURS = 8  # Resolve labels for this many hours per encode call
+HOURLY_INDEX_FILE = 'hourly_index.npz'  # Cached (msg_id, row, hour) per message, next to the embed file
 N_JOBS = 12  # Safe to use >1 now, as we only do CPU work in parallel
+# Up to PRECOMPUTED_MAX_N points, cluster on a precomputed distance matrix. Its
+# peak is about 5 float64 N x N arrays per worker (our matrix, hdbscan's copy,
+# the core-distance partition and two mutual-reachability stages), and all
+# N_JOBS workers may be in it at once, so the cap keeps the total under budget
+PRECOMPUTED_MEMORY_BUDGET = 6 * 2**30  # Bytes, across all workers
+PRECOMPUTED_PEAK_MATRICES = 5
+PRECOMPUTED_MAX_N = int(np.sqrt(PRECOMPUTED_MEMORY_BUDGET / N_JOBS / (PRECOMPUTED_PEAK_MATRICES * 8)))  # 3663
+USE_CUML = True  # Cluster on the GPU (sequentially) when cuML is installed
+USE_UMAP = False  # Opt-in: cluster a UMAP projection (needs umap-learn or cuML); changes the clusters
+UMAP_COMPONENTS = 10
+UMAP_NEIGHBORS = 15
+UMAP_MIN_POINTS = 100  # Smaller hours are clustered in the full embedding space
+UMAP_SEED = 0  # Fixed so the projection (and labels) are reproducible
+UMAP_THREADS = 1  # numba threads per Phase-1 worker; N_JOBS workers already fill the CPUs
 
 # ============================================================================
 # GTE-Large Encoder (GPU Safe)
@@ -62,7 +117,8 @@ class GTELargeEncoder:
             return np.array([])
         
         # Batch processing to avoid OOM on large candidate lists
-        batch_size = 16
+        # (candidates are short phrases, so large batches fit easily on GPU)
+        batch_size = 128 if self.device == 'cuda' else 32
         all_embeddings = []
         
         with torch.inference_mode():
@@ -88,107 +144,253 @@ class GTELargeEncoder:
                     outputs = self.model(**encoded_input)
                     embeddings = average_pool(outputs.last_hidden_state, encoded_input['attention_mask'])
                 
-                embeddings = F.normalize(embeddings.float(), p=2, dim=1)
-                all_embeddings.append(embeddings.cpu().numpy())
+                # Keep batches on the device; one transfer to host at the end
+                all_embeddings.append(F.normalize(embeddings.float(), p=2, dim=1))
                 
-        return np.concatenate(all_embeddings, axis=0) if all_embeddings else np.array([])
+            return torch.cat(all_embeddings).cpu().numpy()
 
 # ============================================================================
 # Math Helpers
 # ============================================================================
 
 def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
-    """L2 Normalize numpy array (N, D)."""
-    norm = np.linalg.norm(vectors, axis=1, keepdims=True)
+    """
+    L2 Normalize float numpy array (N, D) in place and return it.
+    einsum sums the squares without an (N, D) temporary, and the divide writes
+    back into the input, so no extra copy of the embeddings is allocated.
+    """
+    norm = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))[:, None]
     # Avoid division by zero
-    return vectors / (norm + 1e-10)
+    norm += 1e-10
+    vectors /= norm
+    return vectors
+
+def pairwise_distances_normalized(norm_embeddings: np.ndarray) -> np.ndarray:
+    """
+    Euclidean distance matrix (N, N) for L2-normalized rows, from one GEMM:
+    ||a - b||^2 = 2 - 2 * (a . b). Same distances HDBSCAN computes with
+    metric='euclidean', without its per-pair tree queries in high dimensions.
+    """
+    # float64: in float32 the cancellation in 2 - 2(a . b) distorts distances
+    # between near-duplicate messages
+    x = np.asarray(norm_embeddings, dtype=np.float64)
+    dist = x @ x.T
+    dist *= -2.0
+    dist += 2.0
+    np.maximum(dist, 0.0, out=dist)  # Rounding can dip just below zero
+    np.sqrt(dist, out=dist)
+    np.fill_diagonal(dist, 0.0)
+    return dist
 
-def compute_centroid(embeddings: np.ndarray) -> np.ndarray:
-    """Compute normalized centroid."""
-    centroid = np.mean(embeddings, axis=0)
-    return centroid / (np.linalg.norm(centroid) + 1e-10)
+def cosine_distance_batch(embeddings: np.ndarray, centroid: np.ndarray) -> np.ndarray:
+    """Cosine distances (N,) between normalized embeddings (N, D) and a normalized centroid (D,)."""
+    return 1.0 - embeddings @ centroid
+
+def compute_centroids(grouped: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """Normalized centroids (K, D) of K consecutive row groups of the given sizes."""
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    centroids = np.add.reduceat(grouped, starts, axis=0) / sizes[:, None]
+    return centroids / (np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-10)
 
 # ============================================================================
 # Phase 1: CPU Parallel Processing (Clustering + Candidate Generation)
 # ============================================================================
 
-def extract_phrases_yake(text: str) -> List[str]:
-    """Extract phrases from text using YAKE (CPU intensive)."""
-    if not text.strip():
-        return []
-        
-    kw_extractor = yake.KeywordExtractor(
+@lru_cache(maxsize=None)
+def get_yake_extractor() -> yake.KeywordExtractor:
+    """
+    One KeywordExtractor per process, built lazily on first use so workers
+    construct their own (stopword loading included) instead of unpickling one.
+    """
+    return yake.KeywordExtractor(
         lan="en",
         n=3,              # Max ngram
         dedupLim=0.7,
         top=20,           # Number of candidates
         features=None
     )
+
+def extract_phrases_yake(text: str) -> List[str]:
+    """Extract phrases from text using YAKE (CPU intensive)."""
+    if not text.strip():
+        return []
     
     try:
-        keywords = kw_extractor.extract_keywords(text)
+        keywords = get_yake_extractor().extract_keywords(text)
         return [kw[0] for kw in keywords]
     except Exception as e:
         return []
 
-def extract_candidates_cpu(
-    hour: int,
-    raw_embeddings: np.ndarray,
-    msg_ids: List[str],
-    msg_map: Dict[str, str],
-    top_k: int
-) -> Dict[str, Any]:
+def cluster_embeddings(norm_embeddings: np.ndarray, use_cuml: bool = False) -> np.ndarray:
     """
-    Run HDBSCAN and YAKE. Returns cluster data with string candidates (no GPU usage).
+    HDBSCAN labels (-1 = noise) for L2-normalized embeddings.
+    With USE_UMAP (off by default), hours of at least UMAP_MIN_POINTS are
+    clustered on a seeded UMAP_COMPONENTS-D cosine UMAP projection instead of
+    the 1024-D vectors, replacing the precomputed and batched paths below;
+    centroids and label selection still use the original embeddings.
     """
-    # 1. Normalize Embeddings
-    norm_embeddings = normalize_vectors(raw_embeddings)
+    reduce = USE_UMAP and len(norm_embeddings) >= UMAP_MIN_POINTS
+    
+    if use_cuml:
+        data = cp.asarray(norm_embeddings)
+        if reduce:
+            data = cuUMAP(
+                n_components=UMAP_COMPONENTS,
+                n_neighbors=UMAP_NEIGHBORS,
+                metric='cosine',
+                random_state=UMAP_SEED
+            ).fit_transform(data)
+        clusterer = cuHDBSCAN(
+            min_cluster_size=MIN_CLUSTER_SIZE,
+            metric='euclidean',
+            cluster_selection_method='eom'
+        )
+        return cp.asnumpy(clusterer.fit_predict(data))
+    
+    if reduce and UMAP_AVAILABLE:
+        # Low-dimensional euclidean HDBSCAN is fast at any hour size, so no batching
+        numba.set_num_threads(UMAP_THREADS)
+        reducer = umap.UMAP(
+            n_components=UMAP_COMPONENTS,
+            n_neighbors=UMAP_NEIGHBORS,
+            metric='cosine',
+            random_state=UMAP_SEED,
+            n_jobs=UMAP_THREADS
+        )
+        clusterer = hdbscan.HDBSCAN(
+            min_cluster_size=MIN_CLUSTER_SIZE,
+            metric='euclidean',
+            cluster_selection_method='eom'
+        )
+        return clusterer.fit_predict(reducer.fit_transform(norm_embeddings))
+    
+    if len(norm_embeddings) <= PRECOMPUTED_MAX_N:
+        return fit_hdbscan(norm_embeddings)
+    return cluster_in_batches(norm_embeddings)
+
+def cluster_in_batches(norm_embeddings: np.ndarray) -> np.ndarray:
+    """
+    HDBSCAN over random batches of ~HDBSCAN_BATCH_SIZE points, then once more
+    over the pooled noise of all batches (itself split into random batches of
+    at most HDBSCAN_BATCH_SIZE). A single run on tens of thousands of points
+    is slow and tends to lump most of them into one cluster; here every
+    HDBSCAN call sees at most HDBSCAN_BATCH_SIZE points, so stays on the
+    precomputed path with bounded cost.
+    Cluster ids are renumbered to be unique across batches.
+    """
+    n = len(norm_embeddings)
+    rng = np.random.default_rng(HDBSCAN_BATCH_SEED)
+    order = rng.permutation(n)
+    labels = np.full(n, -1, dtype=np.int64)
+    next_label = 0
+    
+    def cluster_subset(idx: np.ndarray) -> int:
+        """Write labels for points idx, offset past the ids used so far."""
+        subset_labels = fit_hdbscan(norm_embeddings[idx])
+        found = subset_labels >= 0
+        labels[idx[found]] = subset_labels[found] + next_label
+        return next_label + (int(subset_labels.max()) + 1 if found.any() else 0)
+    
+    for idx in np.array_split(order, int(np.ceil(n / HDBSCAN_BATCH_SIZE))):
+        next_label = cluster_subset(idx)
+    
+    # Give the points no batch could place one more chance together, in
+    # batches of the same bounded size
+    noise = rng.permutation(np.flatnonzero(labels < 0))
+    for idx in np.array_split(noise, max(1, int(np.ceil(len(noise) / HDBSCAN_BATCH_SIZE)))):
+        if len(idx) >= MIN_CLUSTER_SIZE:
+            next_label = cluster_subset(idx)
+    
+    return labels
+
+def fit_hdbscan(norm_embeddings: np.ndarray) -> np.ndarray:
+    """One CPU HDBSCAN run; small inputs use a precomputed distance matrix."""
+    if len(norm_embeddings) <= PRECOMPUTED_MAX_N:
+        clusterer = hdbscan.HDBSCAN(
+            min_cluster_size=MIN_CLUSTER_SIZE,
+            metric='precomputed',
+            cluster_selection_method='eom'
+        )
+        return clusterer.fit_predict(pairwise_distances_normalized(norm_embeddings))
     
-    # 2. Cluster
     clusterer = hdbscan.HDBSCAN(
         min_cluster_size=MIN_CLUSTER_SIZE,
         metric='euclidean', 
         cluster_selection_method='eom'
     )
-    labels = clusterer.fit_predict(norm_embeddings)
+    return clusterer.fit_predict(norm_embeddings)
+
+def extract_candidates_cpu(
+    hour: int,
+    embedding_matrix: np.ndarray,
+    rows: np.ndarray,
+    msg_ids: List[str],
+    top_k: int,
+    use_cuml: bool = False
+) -> Dict[str, Any]:
+    """
+    Run HDBSCAN and pick the messages whose text represents each top cluster
+    (no GPU usage). Returns cluster data with 'text_msg_ids'; message content
+    never reaches the workers, extract_candidates_yake joins it in the driver.
+    The hour's embeddings are gathered here from the memory-mapped matrix, so
+    workers share the sidecar file through the page cache instead of receiving copies.
+    With use_cuml the clustering runs on the GPU, so call it from the main process only.
+    """
+    # HDBSCAN (allow_single_cluster=False) needs at least 2 * MIN_CLUSTER_SIZE
+    # points to return any cluster: skip the gather and the clustering
+    if len(rows) < 2 * MIN_CLUSTER_SIZE:
+        return {
+            'hour': hour,
+            'clusters': [],
+            'stats': {'total': len(msg_ids), 'noise': len(msg_ids)}
+        }
+    
+    # 1. Gather and Normalize Embeddings
+    norm_embeddings = normalize_vectors(embedding_matrix[rows].astype(np.float32))
+    
+    # 2. Cluster
+    labels = cluster_embeddings(norm_embeddings, use_cuml)
     
     # 3. Filter Top Clusters
     counts = Counter(labels[labels >= 0])
     top_cluster_ids = [cid for cid, _ in counts.most_common(top_k)]
     
+    # 4. Gather the top clusters' members once, grouped in top-k order (stable,
+    # so each group keeps message order), and take all centroids in one pass
+    sizes = np.array([counts[cid] for cid in top_cluster_ids], dtype=np.int64)
+    rank = np.full(labels.max() + 2, len(top_cluster_ids))  # Last slot is hit by noise (-1)
+    rank[top_cluster_ids] = np.arange(len(top_cluster_ids))
+    members = np.argsort(rank[labels], kind='stable')[:sizes.sum()]
+    grouped = norm_embeddings[members]
+    centroids = compute_centroids(grouped, sizes) if len(sizes) else grouped
+    
     clusters_data = []
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
     
-    for cluster_id in top_cluster_ids:
-        mask = labels == cluster_id
-        indices = np.where(mask)[0]
+    for k, cluster_id in enumerate(top_cluster_ids):
+        start, end = bounds[k], bounds[k + 1]
         
         # Extract data for this cluster
-        c_msg_ids = [msg_ids[i] for i in indices]
-        c_embeds = norm_embeddings[indices]
-        
-        # Calculate Centroid
-        centroid = compute_centroid(c_embeds)
+        c_msg_ids = [msg_ids[i] for i in members[start:end]]
+        c_embeds = grouped[start:end]
+        centroid = centroids[k]
         
         # Aggregate Text for YAKE
         # Optimization: Take text from top 50 messages closest to centroid
-        dists = [cosine(emb, centroid) for emb in c_embeds]
-        sorted_indices = np.argsort(dists)[:50]
+        dists = cosine_distance_batch(c_embeds, centroid)
+        if len(dists) > 50:
+            # O(n) selection of the 50 closest, then order only those
+            nearest = np.argpartition(dists, 49)[:50]
+            sorted_indices = nearest[np.argsort(dists[nearest])]
+        else:
+            sorted_indices = np.argsort(dists)
         selected_ids = [c_msg_ids[i] for i in sorted_indices]
         
-        raw_texts = [msg_map.get(mid, '') for mid in selected_ids]
-        combined_text = ' '.join(raw_texts)
-        
-        # Truncate to protect YAKE
-        if len(combined_text) > MAX_TEXT_INPUT:
-            combined_text = combined_text[:MAX_TEXT_INPUT]
-            
-        candidates = extract_phrases_yake(combined_text)
-        
         clusters_data.append({
             'cluster_id': int(cluster_id),
             'size': int(len(c_msg_ids)),
-            'centroid': centroid,
-            'candidates': candidates,
+            'centroid': centroid.astype(np.float16),  # Only picks the nearest candidate; halves the pickle
+            'text_msg_ids': selected_ids,
             'sample_msg_ids': c_msg_ids[:5]
         })
         
@@ -201,6 +403,39 @@ def extract_candidates_cpu(
         }
     }
 
+def build_combined_text(text_msg_ids: List[str], msg_map: Dict[str, str]) -> str:
+    """Join the selected messages' content into one YAKE input."""
+    combined_text = ' '.join(msg_map.get(mid, '') for mid in text_msg_ids)
+    
+    # Truncate to protect YAKE
+    if len(combined_text) > MAX_TEXT_INPUT:
+        combined_text = combined_text[:MAX_TEXT_INPUT]
+    return combined_text
+
+def iter_hours_with_candidates(hourly_results: List[Dict[str, Any]], msg_map: Dict[str, str]):
+    """
+    Run YAKE over the clusters of all hours in one process pool, replacing
+    each cluster's 'text_msg_ids' with its 'candidates'. Pooling over
+    (hour, cluster) pairs balances far better than one task per hour.
+    Only the joined text of each cluster is sent to the workers.
+    Yields each hour as soon as all its clusters have candidates, while the
+    pool keeps working on later hours.
+    """
+    # Join all texts before the pool starts, so no task depends on dispatch timing
+    texts = [
+        build_combined_text(cluster.pop('text_msg_ids'), msg_map)
+        for h_data in hourly_results for cluster in h_data['clusters']
+    ]
+    
+    candidate_lists = iter(Parallel(n_jobs=N_JOBS, backend='loky', batch_size=4, return_as='generator')(
+        delayed(extract_phrases_yake)(text) for text in texts
+    ))
+    
+    for h_data in hourly_results:
+        for cluster in h_data['clusters']:
+            cluster['candidates'] = next(candidate_lists)
+        yield h_data
+
 # ============================================================================
 # Phase 2: GPU Sequential Processing (Label Selection)
 # ============================================================================
@@ -210,37 +445,37 @@ def resolve_labels_gpu(
     encoder: GTELargeEncoder
 ) -> List[Dict[str, Any]]:
     """
-    Iterate through pre-computed clusters, embed candidates, and find best label.
+    Embed the candidates of all clusters in one encode call, then pick
+    each cluster's label as the candidate closest to its centroid.
     """
-    print(f"\nResolving labels for {len(hourly_results)} hours using GPU...")
+    print(f"  Resolving labels for {len(hourly_results)} hours using GPU...")
+    
+    # Flatten candidates of every cluster; spans[i] = (start, end) into all_cands
+    all_cands = []
+    spans = []
+    for h_data in hourly_results:
+        for cluster in h_data['clusters']:
+            start = len(all_cands)
+            all_cands.extend(cluster['candidates'])
+            spans.append((start, len(all_cands)))
     
-    final_output = []
+    print(f"  Encoding {len(all_cands)} candidates...")
+    cand_embeds = encoder.encode(all_cands)
     
+    span_iter = iter(spans)
     for h_data in hourly_results:
-        hour = h_data['hour']
-        clusters = h_data['clusters']
-        
-        print(f"  Processing hour {hour:02d}:00 ({len(clusters)} clusters)...")
-        
-        for cluster in clusters:
-            candidates = cluster['candidates']
-            centroid = cluster['centroid']
+        for cluster in h_data['clusters']:
+            start, end = next(span_iter)
+            centroid = cluster.pop('centroid').astype(np.float32)
             
-            if not candidates:
+            if start == end:
                 cluster['label'] = "unknown topic"
                 continue
-                
-            cand_embeds = encoder.encode(candidates)
             
-            dists = [cosine(emb, centroid) for emb in cand_embeds]
-            best_idx = np.argmin(dists)
-            cluster['label'] = candidates[best_idx]
-            
-            del cluster['centroid']
-            
-        final_output.append(h_data)
+            dists = cosine_distance_batch(cand_embeds[start:end], centroid)
+            cluster['label'] = all_cands[start + int(np.argmin(dists))]
         
-    return final_output
+    return hourly_results
 
 # ============================================================================
 # Data Loading and Transformation
@@ -257,114 +492,228 @@ def extract_hour_from_timestamp(timestamp_str: str) -> int:
     except:
         return -1  # Invalid timestamp
 
+ISO_DIGIT_POSITIONS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]  # In 'YYYY-MM-DD HH:MM:SS'
+DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def hours_from_timestamps(timestamps: List[str]) -> np.ndarray:
+    """
+    Hour of day (int8, -1 if invalid) for each timestamp. Strings of exactly
+    the form 'YYYY-MM-DD[T ]HH:MM:SS' (optionally ending in 'Z'), the format
+    conversation_compression writes, are validated field by field and read
+    in one vectorized pass; anything else goes through
+    extract_hour_from_timestamp, so the result always matches it.
+    """
+    hours = np.full(len(timestamps), -1, dtype=np.int8)
+    arr = np.array(timestamps, dtype=str)
+    ok = np.zeros(len(timestamps), dtype=bool)
+    
+    if len(arr) and arr.dtype.itemsize >= 19 * 4:
+        # Fixed-width unicode: one uint32 code point per character
+        codes = arr.view(np.uint32).reshape(len(arr), -1).astype(np.int64)
+        if codes.shape[1] < 20:
+            codes = np.pad(codes, ((0, 0), (0, 20 - codes.shape[1])))
+        codes = codes[:, :20]
+        lengths = np.char.str_len(arr)
+        
+        digits = codes[:, ISO_DIGIT_POSITIONS] - ord('0')
+        fields = digits[:, 0::2] * 10 + digits[:, 1::2]  # YY, YY, MM, DD, HH, MM, SS
+        year = fields[:, 0] * 100 + fields[:, 1]
+        month, day, hour, minute, second = fields[:, 2:].T
+        
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        month_days = DAYS_IN_MONTH[np.clip(month, 0, 12)] + (leap & (month == 2))
+        ok = (((lengths == 19) | ((lengths == 20) & (codes[:, 19] == ord('Z'))))
+              & ((digits >= 0) & (digits <= 9)).all(axis=1)
+              & (codes[:, 4] == ord('-')) & (codes[:, 7] == ord('-'))
+              & ((codes[:, 10] == ord('T')) | (codes[:, 10] == ord(' ')))
+              & (codes[:, 13] == ord(':')) & (codes[:, 16] == ord(':'))
+              & (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_days)
+              & (hour < 24) & (minute < 60) & (second < 60))
+        hours[ok] = hour[ok]
+    
+    for i in np.flatnonzero(~ok):
+        hours[i] = extract_hour_from_timestamp(timestamps[i])
+    return hours
+
+def _json_default(value: Any) -> Any:
+    """Convert NumPy values the JSON encoder does not handle natively."""
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def save_json(path: str, value: Any):
+    """
+    Write indented UTF-8 JSON (the output is read by people and the frontend),
+    using orjson when available. NumPy arrays and scalars are serialized too.
+    """
+    if ORJSON_AVAILABLE:
+        data = orjson.dumps(value, default=_json_default, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+    else:
+        data = json.dumps(value, indent=2, ensure_ascii=False, default=_json_default).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def stream_by_month(path: str):
+    """
+    Return (metadata, iterator over the (month, value) pairs of 'by_month').
+    With ijson the file is streamed, so only one month is parsed at a time;
+    otherwise it is loaded whole.
+    """
+    if IJSON_AVAILABLE:
+        # metadata is written first, so ijson stops after the head of the file
+        with open(path, 'rb') as f:
+            metadata = next(ijson.items(f, 'metadata', use_float=True), {})
+        
+        def months():
+            with open(path, 'rb') as f:
+                yield from ijson.kvitems(f, 'by_month', use_float=True)
+        return metadata, months()
+    
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data.get('metadata', {}), iter(data.get('by_month', {}).items())
+
+def load_hourly_index(embed_file: str, raw_file: str):
+    """
+    Return (metadata, msg_ids, rows, hours) from the cached hourly index,
+    or None if it is missing or older than either input file.
+    """
+    path = os.path.join(os.path.dirname(embed_file), HOURLY_INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    if os.path.getmtime(path) < max(os.path.getmtime(embed_file), os.path.getmtime(raw_file)):
+        return None
+    
+    with np.load(path) as index:
+        return json.loads(str(index['metadata'])), index['msg_ids'], index['rows'], index['hours']
+
+def save_hourly_index(embed_file: str, metadata: Dict[str, Any], hourly_data: Dict[int, Dict[str, Any]]):
+    """
+    Flatten the hourly grouping into arrays, cache them as an .npz next to
+    embed_file and return them as (metadata, msg_ids, rows, hours).
+    """
+    hours_present = sorted(hourly_data)
+    msg_ids = np.array([mid for h in hours_present for mid in hourly_data[h]['msg_ids']], dtype=str)
+    rows = np.concatenate([np.frombuffer(hourly_data[h]['rows'], dtype=np.int64) for h in hours_present]
+                          or [np.empty(0, dtype=np.int64)])
+    hours = np.repeat(np.array(hours_present, dtype=np.int8),
+                      [len(hourly_data[h]['rows']) for h in hours_present])
+    
+    path = os.path.join(os.path.dirname(embed_file), HOURLY_INDEX_FILE)
+    np.savez(path, metadata=np.array(json.dumps(metadata)), msg_ids=msg_ids, rows=rows, hours=hours)
+    return metadata, msg_ids, rows, hours
+
 def load_and_transform_to_hourly(embed_file: str, raw_file: str):
     """
     Loads monthly embeddings and transforms them to hourly grouping.
-    Deletes monthly data from memory after transformation.
+    Both files are streamed month by month (see stream_by_month), so the
+    parsed JSON of neither is held in memory as a whole. The grouping is cached
+    in HOURLY_INDEX_FILE, so later runs skip parsing the embed file entirely.
+    Returns per-hour (row indices, msg_ids), the message map and the
+    memory-mapped embedding matrix the row indices refer to.
     """
     print("Loading data...")
-    with open(embed_file, 'r', encoding='utf-8') as f:
-        embed_data = json.load(f)
-    with open(raw_file, 'r', encoding='utf-8') as f:
-        raw_data = json.load(f)
         
-    # 1. Build message map and timestamp map
+    # 1. Build message map and hour-of-day map
     print("  Mapping raw content and timestamps...")
     msg_map = {}
-    msg_timestamps = {}
+    ts_ids = []
+    ts_list = []
     
-    for m_list in raw_data.get('by_month', {}).values():
+    _, raw_months = stream_by_month(raw_file)
+    for _, m_list in raw_months:
         for msg in m_list:
             msg_id = msg.get('id')
             if msg_id and msg.get('content'):
                 msg_map[msg_id] = msg['content']
                 if msg.get('timestamp'):
-                    msg_timestamps[msg_id] = msg['timestamp']
+                    ts_ids.append(msg_id)
+                    ts_list.append(msg['timestamp'])
     
-    # Delete raw_data to free memory
-    del raw_data
+    del raw_months  # Without ijson this holds the whole parsed file
+    msg_hours = dict(zip(ts_ids, hours_from_timestamps(ts_list).tolist()))
+    del ts_ids, ts_list
     print(f"  Mapped {len(msg_map)} messages with content")
                 
     # 2. Transform embeddings from monthly to hourly grouping
+    index = load_hourly_index(embed_file, raw_file)
+    if index is not None:
+        print(f"  Using cached hourly index ({HOURLY_INDEX_FILE})")
+    else:
+        index = transform_to_hourly(embed_file, msg_map, msg_hours)
+    del msg_hours
+    
+    metadata, msg_ids_all, rows_all, hours_all = index
+    embedding_matrix = load_embedding_matrix(embed_file, metadata)
+    
+    # 3. Convert to final format
+    hourly_inputs = {}
+    for hour in range(24):  # Ensure all 24 hours are represented
+        sel = np.flatnonzero(hours_all == hour)
+        if len(sel):
+            hourly_inputs[hour] = (rows_all[sel], msg_ids_all[sel].tolist())
+            print(f"    Hour {hour:02d}:00 - {len(sel)} messages")
+        else:
+            print(f"    Hour {hour:02d}:00 - 0 messages (skipped)")
+    
+    return hourly_inputs, msg_map, embedding_matrix
+
+def transform_to_hourly(embed_file: str, msg_map: Dict[str, str], msg_hours: Dict[str, int]):
+    """
+    Stream the embed file and group messages by hour of day.
+    Returns (metadata, msg_ids, rows, hours) and caches them (save_hourly_index).
+    """
     print("  Transforming monthly to hourly grouping...")
-    hourly_data = defaultdict(lambda: {'embeddings': [], 'msg_ids': []})
+    metadata, embed_months = stream_by_month(embed_file)
+    hourly_data = defaultdict(lambda: {'rows': array('q'), 'msg_ids': []})
     total_processed = 0
     skipped_no_timestamp = 0
     
-    for month, convs in embed_data.get('by_month', {}).items():
+    for month, convs in embed_months:
         for _, msg_groups in convs.items():
             for group in msg_groups:
                 for msg in group:
                     msg_id = msg.get('id')
-                    embeds = msg.get('embeddings')
+                    row = first_embedding_row(msg)
                     
                     # Check if we have all required data
-                    if msg_id and embeds and (msg_id in msg_map) and (msg_id in msg_timestamps):
-                        hour = extract_hour_from_timestamp(msg_timestamps[msg_id])
+                    if msg_id and row is not None and (msg_id in msg_map) and (msg_id in msg_hours):
+                        hour = msg_hours[msg_id]
                         
                         if hour >= 0:  # Valid hour
-                            hourly_data[hour]['embeddings'].append(embeds[0])
+                            hourly_data[hour]['rows'].append(row)
                             hourly_data[hour]['msg_ids'].append(msg_id)
                             total_processed += 1
                         else:
                             skipped_no_timestamp += 1
-                    elif msg_id and embeds and (msg_id in msg_map):
+                    elif msg_id and row is not None and (msg_id in msg_map):
                         skipped_no_timestamp += 1
     
-    # Delete embed_data to free memory
-    del embed_data
+    del embed_months
     print(f"  Transformed {total_processed} messages into {len(hourly_data)} hours")
     print(f"  Skipped {skipped_no_timestamp} messages without valid timestamps")
     
-    # 3. Convert to final format
-    hourly_inputs = {}
-    for hour in range(24):  # Ensure all 24 hours are represented
-        if hour in hourly_data and hourly_data[hour]['embeddings']:
-            embeddings = np.array(hourly_data[hour]['embeddings'], dtype=np.float32)
-            msg_ids = hourly_data[hour]['msg_ids']
-            hourly_inputs[hour] = (embeddings, msg_ids)
-            print(f"    Hour {hour:02d}:00 - {len(msg_ids)} messages")
-        else:
-            print(f"    Hour {hour:02d}:00 - 0 messages (skipped)")
-    
-    # Delete hourly_data to free memory
-    del hourly_data
-    
-    return hourly_inputs, msg_map
+    return save_hourly_index(embed_file, metadata, hourly_data)
 
 def aggregate_hourly_topics(hourly_results: List[Dict[str, Any]], top_k: int = 3) -> Dict[str, Any]:
     """
     Aggregate cluster labels by hour to identify top topics for each hour of day.
     Weighted by cluster size.
     """
-    hourly_labels = defaultdict(list)
-    
-    # Collect all cluster labels by hour
+    # Message counts per label for each hour, weighted by cluster size
+    hourly_counts = defaultdict(Counter)
     for hour_result in hourly_results:
-        hour = hour_result['hour']
-        
+        counts = hourly_counts[hour_result['hour']]
         for cluster in hour_result.get('clusters', []):
-            label = cluster.get('label', 'unknown')
-            size = cluster.get('size', 0)
-            hourly_labels[hour].append((label, size))
+            counts[cluster.get('label', 'unknown')] += cluster.get('size', 0)
     
-    # Aggregate and rank topics by hour
+    # Rank topics by hour (most_common(k) is a heap selection, not a full sort)
     hourly_topics = {}
     for hour in range(24):
-        if hour in hourly_labels:
-            labels = hourly_labels[hour]
-            
-            # Count label frequencies weighted by cluster size
-            label_weights = defaultdict(int)
-            for label, size in labels:
-                label_weights[label] += size
-            
-            # Get top K topics
-            top_topics = sorted(label_weights.items(), key=lambda x: x[1], reverse=True)[:top_k]
-            
+        if hour in hourly_counts:
             hourly_topics[f"{hour:02d}:00"] = [
                 {'topic': label, 'total_messages': weight}
-                for label, weight in top_topics
+                for label, weight in hourly_counts[hour].most_common(top_k)
             ]
         else:
             hourly_topics[f"{hour:02d}:00"] = []
@@ -381,31 +730,62 @@ def main():
     OUT_FILE = 'hourly_topics.json'
     
     # 1. Load and Transform Data (monthly -> hourly)
-    hourly_inputs, msg_map = load_and_transform_to_hourly(EMBED_FILE, RAW_FILE)
+    hourly_inputs, msg_map, embedding_matrix = load_and_transform_to_hourly(EMBED_FILE, RAW_FILE)
     
     if not hourly_inputs:
         print("\nERROR: No hourly data to process. Check if timestamps exist in your data.")
         return
     
+    # Load the encoder in the background; it is ready by the time labels are resolved
+    loader = ThreadPoolExecutor(max_workers=1)
+    encoder_future = loader.submit(GTELargeEncoder)
+    
     # 2. Phase 1: CPU Parallel
     print(f"\nPhase 1: Generating candidates (Parallel CPU, n_jobs={N_JOBS})...")
     start_cpu = datetime.now()
     
-    cpu_results = Parallel(n_jobs=N_JOBS)(
-        delayed(extract_candidates_cpu)(hour, embs, ids, msg_map, TOP_K_CLUSTERS)
-        for hour, (embs, ids) in sorted(hourly_inputs.items())
-    )
+    if USE_CUML and CUML_AVAILABLE:
+        # GPU clustering: one hour at a time in this process (YAKE still runs in the pool below)
+        print("  Clustering on GPU with cuML")
+        cpu_results = [
+            extract_candidates_cpu(hour, embedding_matrix, rows, ids, TOP_K_CLUSTERS, use_cuml=True)
+            for hour, (rows, ids) in sorted(hourly_inputs.items())
+        ]
+    else:
+        # The matrix is an np.memmap (or a QuantizedMatrix of memmaps), which loky
+        # pickles by file reference: each worker reopens the sidecar read-only.
+        # Any other array argument over max_nbytes is dumped once and memmapped too
+        cpu_results = Parallel(n_jobs=N_JOBS, backend='loky', max_nbytes='1M', mmap_mode='r')(
+            delayed(extract_candidates_cpu)(hour, embedding_matrix, rows, ids, TOP_K_CLUSTERS)
+            for hour, (rows, ids) in sorted(hourly_inputs.items())
+        )
+    
+    # Row indices and ids are only needed for clustering
+    del hourly_inputs
+    gc.collect()
+    print(f"Clustering complete in {(datetime.now() - start_cpu).total_seconds():.1f}s")
     
-    print(f"Phase 1 complete in {(datetime.now() - start_cpu).total_seconds():.1f}s")
+    # 3. YAKE (CPU pool) and label resolution (GPU), overlapped: every
+    # LABEL_FLUSH_HOURS hours that have candidates are labelled in one encode
+    # call while YAKE continues on the remaining hours
+    print("\nPhase 2: Waiting for GTE-Large...")
+    encoder = encoder_future.result()
+    loader.shutdown()
     
-    # Delete msg_map to free memory
-    del msg_map
+    hourly_results = []
+    ready = []
+    for h_data in iter_hours_with_candidates(cpu_results, msg_map):
+        ready.append(h_data)
+        if len(ready) >= LABEL_FLUSH_HOURS:
+            hourly_results.extend(resolve_labels_gpu(ready, encoder))
+            ready = []
+    if ready:
+        hourly_results.extend(resolve_labels_gpu(ready, encoder))
     
-    # 3. Phase 2: GPU Sequential
-    print("\nPhase 2: Initializing GTE-Large...")
-    encoder = GTELargeEncoder()
+    print(f"Candidates and labels complete in {(datetime.now() - start_cpu).total_seconds():.1f}s")
     
-    hourly_results = resolve_labels_gpu(cpu_results, encoder)
+    # Delete msg_map and the matrix mapping to free memory
+    del msg_map, embedding_matrix
 
     # 4. Aggregation: Hourly Top Topics
     print("\nAggregating Hourly Topics...")
@@ -425,15 +805,14 @@ def main():
     
     # 5. Save
     print(f"\nSaving to {OUT_FILE}...")
-    with open(OUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump({
-            'metadata': {
-                'generated_at': str(datetime.now()),
-                'description': 'Top topics for each hour of the day (0-23) across entire year'
-            },
-            'hourly_summary': hourly_topics,
-            'hourly_details': hourly_results
-        }, f, indent=2, ensure_ascii=False)
+    save_json(OUT_FILE, {
+        'metadata': {
+            'generated_at': str(datetime.now()),
+            'description': 'Top topics for each hour of the day (0-23) across entire year'
+        },
+        'hourly_summary': hourly_topics,
+        'hourly_details': hourly_results
+    })
     
     print("\n✅ Hourly topic discovery complete!")
 
@@ -20,6 +20,8 @@ from multiprocessing.shared_memory import SharedMemory
 from functools import partial
 import warnings
 
+from ml.embedding_store import load_embedding_matrix, first_embedding_row
+
 # Try to import FAISS for optimized similarity search (optional)
 try:
     import faiss
@@ -27,6 +29,21 @@ try:
 except ImportError:
     FAISS_AVAILABLE = False
 
+# Try to import orjson for faster JSON loading (optional)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+def load_json(path: str) -> Any:
+    """Load a JSON file, using orjson when available."""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if ORJSON_AVAILABLE:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 # --- GLOBAL WORKER STATE ---
 # These variables are only populated inside worker processes
 _worker_shm = None
@@ -127,10 +144,13 @@ def parse_timestamp(ts_str: str) -> datetime:
 
 # --- SHARED MEMORY MANAGEMENT ---
 
-def create_shared_embeddings(embedded_data: Dict[str, Any]) -> Tuple[Dict[str, int], SharedMemory, int, Tuple[int, int]]:
+def create_shared_embeddings(embedded_data: Dict[str, Any], embedding_matrix: np.ndarray) -> Tuple[Dict[str, int], SharedMemory, int, Tuple[int, int]]:
     """
     Create REAL shared memory for all normalized embeddings.
     
+    Messages reference rows of embedding_matrix (the memory-mapped side file);
+    only the rows actually used are read and copied into shared memory.
+    
     Returns:
         - embeddings_index: Dict mapping message_id -> row_index in shared array
         - shared_mem: SharedMemory object
@@ -139,10 +159,9 @@ def create_shared_embeddings(embedded_data: Dict[str, Any]) -> Tuple[Dict[str, i
     """
     print("Creating shared memory for embeddings...")
     
-    # First pass: collect all embeddings and determine size
-    all_embeddings = []
+    # First pass: collect the embedding row of every message
+    rows = []
     message_ids = []
-    embedding_dim = None
     
     for month, convs in embedded_data.get('by_month', {}).items():
         for conv_id, msg_groups in convs.items():
@@ -152,23 +171,19 @@ def create_shared_embeddings(embedded_data: Dict[str, Any]) -> Tuple[Dict[str, i
                     if not msg_id:
                         continue
                     
-                    # Extract and normalize first valid embedding
-                    if msg.get('embeddings'):
-                        for emb in msg['embeddings']:
-                            if emb and len(emb) > 0:
-                                normalized = normalize_embedding(emb)
-                                if embedding_dim is None:
-                                    embedding_dim = len(normalized)
-                                all_embeddings.append(normalized)
-                                message_ids.append(msg_id)
-                                break
-    
-    if not all_embeddings:
+                    # Use the first valid embedding
+                    row = first_embedding_row(msg)
+                    if row is not None:
+                        rows.append(row)
+                        message_ids.append(msg_id)
+    
+    if not rows:
         print("  No embeddings found!")
         return {}, None, 0, (0, 0)
     
     # Create shared memory
-    num_embeddings = len(all_embeddings)
+    num_embeddings = len(rows)
+    embedding_dim = embedding_matrix.shape[1]
     shape = (num_embeddings, embedding_dim)
     # Calculate bytes: rows * cols * 4 bytes (float32)
     total_size = num_embeddings * embedding_dim * 4
@@ -184,10 +199,11 @@ def create_shared_embeddings(embedded_data: Dict[str, Any]) -> Tuple[Dict[str, i
     # Create numpy array backed by shared memory
     shared_array = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
     
-    # Copy embeddings to shared memory
+    # Gather rows into shared memory as float32, then normalize in place
     print("  Populating shared memory...")
-    for i, emb in enumerate(all_embeddings):
-        shared_array[i] = emb
+    shared_array[:] = embedding_matrix[rows]
+    norms = np.linalg.norm(shared_array, axis=1, keepdims=True)
+    np.divide(shared_array, norms, out=shared_array, where=norms > 0)
     
     # Create index mapping message_id -> row_index
     # We don't need to store size/dim per message since it's uniform
@@ -559,6 +575,13 @@ def search_message_by_id(embedded_data: Dict[str, Any], message_id: str) -> Opti
                         return msg
     return None
 
+def export_message(message: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # The 'embeddings' field only holds row indices into the .npy side file,
+    # which mean nothing outside this run's output
+    if not message:
+        return message
+    return {k: v for k, v in message.items() if k != 'embeddings'}
+
 def extract_raw_content(message: Dict[str, Any]) -> str:
     if not message:
         return ""
@@ -591,14 +614,15 @@ def main():
         return
         
     try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            embedded_data = json.load(f)
+        embedded_data = load_json(input_file)
     except json.JSONDecodeError as e:
         print(f"Error: Invalid JSON: {e}")
         return
 
     # PHASE 1: Create Shared Memory
-    embeddings_index, shm, embedding_dim, shape = create_shared_embeddings(embedded_data)
+    embedding_matrix = load_embedding_matrix(input_file, embedded_data['metadata'])
+    embeddings_index, shm, embedding_dim, shape = create_shared_embeddings(embedded_data, embedding_matrix)
+    del embedding_matrix
     
     if shm is None:
         return
@@ -655,7 +679,7 @@ def main():
             'metrics': hardest['metrics'],
             'question_id': hardest['question_id'],
             'text': q_text,
-            'full_message': raw_msg
+            'full_message': export_message(raw_msg)
         }
         
     if easiest:
@@ -668,7 +692,7 @@ def main():
             'metrics': easiest['metrics'],
             'question_id': easiest['question_id'],
             'text': q_text,
-            'full_message': raw_msg
+            'full_message': export_message(raw_msg)
         }
 
     # Save to new JSON file
@@ -708,14 +732,15 @@ def analyze_questions(embedded_file: str, output_dir: str = '.', similarity_thre
         raise FileNotFoundError(embedded_file)
         
     try:
-        with open(embedded_file, 'r', encoding='utf-8') as f:
-            embedded_data = json.load(f)
+        embedded_data = load_json(embedded_file)
     except json.JSONDecodeError as e:
         print(f"Error: Invalid JSON: {e}")
         raise
 
     # PHASE 1: Create Shared Memory
-    embeddings_index, shm, embedding_dim, shape = create_shared_embeddings(embedded_data)
+    embedding_matrix = load_embedding_matrix(embedded_file, embedded_data['metadata'])
+    embeddings_index, shm, embedding_dim, shape = create_shared_embeddings(embedded_data, embedding_matrix)
+    del embedding_matrix
     
     if shm is None:
         raise RuntimeError("Failed to create shared memory for embeddings")
@@ -772,7 +797,7 @@ def analyze_questions(embedded_file: str, output_dir: str = '.', similarity_thre
             'metrics': hardest['metrics'],
             'question_id': hardest['question_id'],
             'text': q_text,
-            'full_message': raw_msg
+            'full_message': export_message(raw_msg)
         }
         
     if easiest:
@@ -785,7 +810,7 @@ def analyze_questions(embedded_file: str, output_dir: str = '.', similarity_thre
             'metrics': easiest['metrics'],
             'question_id': easiest['question_id'],
             'text': q_text,
-            'full_message': raw_msg
+            'full_message': export_message(raw_msg)
         }
 
     # Save to new JSON file
@@ -1,99 +1,129 @@
 #!/usr/bin/env python3
 """
 Examples of how to group and analyze topics from question_analytics results.
+
+Topics are loaded once into a column-oriented `TopicTable`; the helpers below
+operate on its NumPy columns and return integer index arrays into the table.
+Use `TopicTable.topics(indices)` to get the topic dicts back when needed.
 """
 
 import json
-from collections import defaultdict
+from datetime import datetime
 from typing import List, Dict, Any
 
+import numpy as np
+
+
+class TopicTable:
+    """
+    Column-oriented (struct-of-arrays) view of a flat list of topic dicts.
+
+    Every field the grouping/statistics helpers read is materialized once into
+    a contiguous NumPy column instead of being re-extracted from the dicts on
+    each call.
+    """
+
+    def __init__(self, all_topics: List[Dict[str, Any]]):
+        self.idx_to_topic = all_topics
+        metrics = [t['metrics'] for t in all_topics]
+
+        self.scores = np.array([t['difficulty_score'] for t in all_topics], dtype=np.float64)
+        self.frustration = np.array([bool(m.get('frustration_flag', False)) for m in metrics], dtype=bool)
+        self.resolution = np.array([bool(m.get('resolution_flag', False)) for m in metrics], dtype=bool)
+        self.followups = np.array([m.get('followup_count', 0) for m in metrics], dtype=np.int64)
+        self.duration = np.array([m.get('duration_seconds', 0) for m in metrics], dtype=np.float64)
+        self.months = np.array([t['month'] for t in all_topics], dtype=str)
+        self.conv_ids = np.array([t['conv_id'] for t in all_topics], dtype=str)
+        self.hours = np.array([_hour_of_day(t.get('timestamp')) for t in all_topics], dtype=np.int8)
+
+    def __len__(self) -> int:
+        return len(self.idx_to_topic)
+
+    def topics(self, indices) -> List[Dict]:
+        """Convert an index array back into the corresponding topic dicts."""
+        return [self.idx_to_topic[i] for i in indices]
+
+
+def _hour_of_day(timestamp: Any) -> int:
+    """Hour of day (0-23) for a topic timestamp, or -1 if missing/unparseable."""
+    if not timestamp:
+        return -1
+    try:
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).hour
+    except:
+        return -1
+
 
-def group_topics_by_month(all_topics: List[Dict[str, Any]]) -> Dict[str, List[Dict]]:
+def _group_by_column(column: np.ndarray) -> Dict[Any, np.ndarray]:
+    """Map each distinct value in `column` to the indices where it occurs."""
+    # One stable sort, then split at the boundaries between runs of equal keys
+    order = np.argsort(column, kind='stable')
+    keys, starts = np.unique(column[order], return_index=True)
+    return {key.item(): idx for key, idx in zip(keys, np.split(order, starts[1:]))}
+
+
+def group_topics_by_month(table: TopicTable) -> Dict[str, np.ndarray]:
     """Group all topics by month."""
-    by_month = defaultdict(list)
-    for topic in all_topics:
-        by_month[topic['month']].append(topic)
-    return dict(by_month)
+    return _group_by_column(table.months)
 
 
-def group_topics_by_conversation(all_topics: List[Dict[str, Any]]) -> Dict[str, List[Dict]]:
+def group_topics_by_conversation(table: TopicTable) -> Dict[str, np.ndarray]:
     """Group all topics by conversation ID."""
-    by_conv = defaultdict(list)
-    for topic in all_topics:
-        by_conv[topic['conv_id']].append(topic)
-    return dict(by_conv)
+    return _group_by_column(table.conv_ids)
 
 
-def group_topics_by_difficulty_range(all_topics: List[Dict[str, Any]]) -> Dict[str, List[Dict]]:
+def group_topics_by_difficulty_range(table: TopicTable) -> Dict[str, np.ndarray]:
     """Group topics by difficulty score ranges."""
-    ranges = {
-        'very_easy': [],    # < 0
-        'easy': [],         # 0-50
-        'medium': [],       # 50-100
-        'hard': [],         # 100-200
-        'very_hard': []     # > 200
-    }
-    
-    for topic in all_topics:
-        score = topic['difficulty_score']
-        if score < 0:
-            ranges['very_easy'].append(topic)
-        elif score < 50:
-            ranges['easy'].append(topic)
-        elif score < 100:
-            ranges['medium'].append(topic)
-        elif score < 200:
-            ranges['hard'].append(topic)
-        else:
-            ranges['very_hard'].append(topic)
-    
-    return ranges
-
-
-def get_top_n_hardest_topics(all_topics: List[Dict[str, Any]], n: int = 10) -> List[Dict]:
+    range_names = [
+        'very_easy',    # < 0
+        'easy',         # 0-50
+        'medium',       # 50-100
+        'hard',         # 100-200
+        'very_hard'     # > 200
+    ]
+    bins = np.digitize(table.scores, [0, 50, 100, 200])
+    return {name: np.flatnonzero(bins == i) for i, name in enumerate(range_names)}
+
+
+def get_top_n_hardest_topics(table: TopicTable, n: int = 10) -> np.ndarray:
     """Get the N hardest topics."""
-    return sorted(all_topics, key=lambda x: x['difficulty_score'], reverse=True)[:n]
+    if n <= 0:
+        return np.array([], dtype=np.intp)
+    if n >= len(table):
+        return np.argsort(-table.scores, kind='stable')
+
+    # O(N) partial selection, then sort only the n selected scores
+    top = np.argpartition(-table.scores, n - 1)[:n]
+    return top[np.argsort(-table.scores[top], kind='stable')]
 
 
-def get_topics_with_frustration(all_topics: List[Dict[str, Any]]) -> List[Dict]:
+def get_topics_with_frustration(table: TopicTable) -> np.ndarray:
     """Get all topics that had frustration signals."""
-    return [t for t in all_topics if t['metrics'].get('frustration_flag', False)]
+    return np.flatnonzero(table.frustration)
 
 
-def group_topics_by_hour_of_day(all_topics: List[Dict[str, Any]]) -> Dict[int, List[Dict]]:
+def group_topics_by_hour_of_day(table: TopicTable) -> Dict[int, np.ndarray]:
     """Group topics by hour of day (0-23)."""
-    from datetime import datetime
-    
-    by_hour = defaultdict(list)
-    for topic in all_topics:
-        if topic.get('timestamp'):
-            try:
-                # Parse timestamp and extract hour
-                ts = datetime.fromisoformat(topic['timestamp'].replace('Z', '+00:00'))
-                hour = ts.hour
-                by_hour[hour].append(topic)
-            except:
-                pass
-    
-    return dict(by_hour)
+    valid = table.hours >= 0
+    groups = _group_by_column(table.hours[valid])
+    valid_idx = np.flatnonzero(valid)
+    return {hour: valid_idx[idx] for hour, idx in groups.items()}
 
 
-def get_topic_statistics(all_topics: List[Dict[str, Any]]) -> Dict[str, Any]:
+def get_topic_statistics(table: TopicTable) -> Dict[str, Any]:
     """Get overall statistics about topics."""
-    if not all_topics:
+    if not len(table):
         return {}
     
-    difficulty_scores = [t['difficulty_score'] for t in all_topics]
-    
     return {
-        'total_topics': len(all_topics),
-        'avg_difficulty': sum(difficulty_scores) / len(difficulty_scores),
-        'min_difficulty': min(difficulty_scores),
-        'max_difficulty': max(difficulty_scores),
-        'topics_with_frustration': sum(1 for t in all_topics if t['metrics'].get('frustration_flag')),
-        'topics_with_resolution': sum(1 for t in all_topics if t['metrics'].get('resolution_flag')),
-        'avg_followups': sum(t['metrics'].get('followup_count', 0) for t in all_topics) / len(all_topics),
-        'avg_duration_minutes': sum(t['metrics'].get('duration_seconds', 0) for t in all_topics) / len(all_topics) / 60,
+        'total_topics': len(table),
+        'avg_difficulty': float(table.scores.mean()),
+        'min_difficulty': float(table.scores.min()),
+        'max_difficulty': float(table.scores.max()),
+        'topics_with_frustration': int(table.frustration.sum()),
+        'topics_with_resolution': int(table.resolution.sum()),
+        'avg_followups': float(table.followups.mean()),
+        'avg_duration_minutes': float(table.duration.mean()) / 60,
     }
 
 
@@ -106,10 +136,10 @@ def load_segmented_topics(segmented_file: str = 'segmented_conversations.json')
         return json.load(f)
 
 
-def extract_topics_with_messages(segmented_file: str = 'segmented_conversations.json') -> List[Dict]:
+def extract_topics_with_messages(segmented_file: str = 'segmented_conversations.json') -> TopicTable:
     """
     Extract all topics with their full messages from segmented file.
-    Returns a flat list of topic dicts with messages.
+    Returns a TopicTable over the flat list of topic dicts with messages.
     """
     segmented = load_segmented_topics(segmented_file)
     all_topics_with_messages = []
@@ -129,7 +159,7 @@ def extract_topics_with_messages(segmented_file: str = 'segmented_conversations.
                 }
                 all_topics_with_messages.append(topic_info)
     
-    return all_topics_with_messages
+    return TopicTable(all_topics_with_messages)
 
 
 # Example usage
@@ -162,30 +192,33 @@ if __name__ == '__main__':
     
     print(f"Total topics found: {len(all_topics)}")
     
+    # Build the column table once and reuse it for every helper below
+    table = TopicTable(all_topics)
+    
     # Group by month
-    by_month = group_topics_by_month(all_topics)
+    by_month = group_topics_by_month(table)
     print(f"\nTopics by month:")
     for month, topics in sorted(by_month.items()):
         print(f"  {month}: {len(topics)} topics")
     
     # Group by difficulty
-    by_difficulty = group_topics_by_difficulty_range(all_topics)
+    by_difficulty = group_topics_by_difficulty_range(table)
     print(f"\nTopics by difficulty:")
     for range_name, topics in by_difficulty.items():
         print(f"  {range_name}: {len(topics)} topics")
     
     # Get statistics
-    stats = get_topic_statistics(all_topics)
+    stats = get_topic_statistics(table)
     print(f"\nOverall statistics:")
     for key, value in stats.items():
         print(f"  {key}: {value:.2f}" if isinstance(value, float) else f"  {key}: {value}")
     
     # Get top 5 hardest
-    hardest = get_top_n_hardest_topics(all_topics, 5)
+    hardest = get_top_n_hardest_topics(table, 5)
     print(f"\nTop 5 hardest topics:")
-    for i, topic in enumerate(hardest, 1):
+    for i, topic in enumerate(table.topics(hardest), 1):
         print(f"  {i}. Score: {topic['difficulty_score']:.2f} (Month: {topic['month']}, Conv: {topic['conv_id'][:8]}...)")
     
     # Topics with frustration
-    frustrated = get_topics_with_frustration(all_topics)
+    frustrated = get_topics_with_frustration(table)
     print(f"\nTopics with frustration: {len(frustrated)}")
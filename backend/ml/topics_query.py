@@ -20,6 +20,8 @@ import hdbscan
 import yake
 from joblib import Parallel, delayed
 
+from ml.embedding_store import load_embedding_matrix, first_embedding_row
+
 # For GTE-Large encoding
 import torch
 import torch.nn.functional as F
@@ -253,6 +255,7 @@ def load_data(embed_file: str, raw_file: str):
     # FIX: Added encoding='utf-8' to both open() calls
     with open(embed_file, 'r', encoding='utf-8') as f:
         embed_data = json.load(f)
+    embedding_matrix = load_embedding_matrix(embed_file, embed_data['metadata'])
     with open(raw_file, 'r', encoding='utf-8') as f:
         raw_data = json.load(f)
         
@@ -270,21 +273,21 @@ def load_data(embed_file: str, raw_file: str):
     total_loaded = 0
     
     for month, convs in embed_data.get('by_month', {}).items():
-        e_list, id_list = [], []
+        row_list, id_list = [], []
         for _, msg_groups in convs.items():
             for group in msg_groups:
                 for msg in group:
                     msg_id = msg.get('id')
-                    embeds = msg.get('embeddings')
+                    row = first_embedding_row(msg)
                     
                     # CRITICAL CHECK: ensure we have text for this embedding
-                    if msg_id and embeds and (msg_id in msg_map):
-                        e_list.append(embeds[0])
+                    if msg_id and row is not None and (msg_id in msg_map):
+                        row_list.append(row)
                         id_list.append(msg_id)
                         total_loaded += 1
         
-        if e_list:
-            monthly_inputs[month] = (np.array(e_list, dtype=np.float32), id_list)
+        if row_list:
+            monthly_inputs[month] = (embedding_matrix[row_list].astype(np.float32), id_list)
             
     print(f"  Aligned {total_loaded} messages across {len(monthly_inputs)} months.")
     return monthly_inputs, msg_map